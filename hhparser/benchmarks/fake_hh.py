@@ -0,0 +1,155 @@
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+AREAS = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань']
+EXPERIENCE = ['Нет опыта', 'От 1 года до 3 лет', 'От 3 до 6 лет', 'Более 6 лет']
+EMPLOYMENT = ['Полная занятость', 'Частичная занятость', 'Стажировка']
+SCHEDULE = ['Полный день', 'Сменный график', 'Гибкий график', 'Удаленная работа']
+ROLES = ['Программист, разработчик', 'Тестировщик', 'Аналитик', 'DevOps-инженер', 'Системный администратор']
+CURRENCIES = ['RUR', 'RUR', 'RUR', 'USD', 'EUR', 'KZT']
+MAX_DEPTH = 2000
+
+# Синтетическая вакансия в формате ответа api.hh.ru
+def make_item(i, published_at, rnd):
+    salary = None
+    if rnd.random() < 0.7:
+        salary_from = rnd.randrange(30, 400) * 1000
+        salary = {
+            'from': salary_from if rnd.random() < 0.8 else None,
+            'to': salary_from + rnd.randrange(0, 200) * 1000 if rnd.random() < 0.6 else None,
+            'currency': rnd.choice(CURRENCIES),
+            'gross': rnd.random() < 0.5,
+        }
+        if salary['from'] is None and salary['to'] is None:
+            salary['from'] = salary_from
+    return {
+        'id': str(100000 + i),
+        'name': f'Python разработчик {i}',
+        'published_at': published_at.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'area': {'name': rnd.choice(AREAS)},
+        'salary': salary,
+        'experience': {'name': rnd.choice(EXPERIENCE)},
+        'employment': {'name': rnd.choice(EMPLOYMENT)},
+        'schedule': {'name': rnd.choice(SCHEDULE)},
+        'professional_roles': [{'name': role} for role in rnd.sample(ROLES, rnd.randint(1, 2))],
+        'snippet': {'responsibility': 'Разработка и поддержка сервисов на Python. ' * rnd.randint(1, 4)},
+        'alternate_url': f'https://hh.ru/vacancy/{100000 + i}',
+        'employer': {'name': f'Компания {rnd.randrange(500)}'},
+    }
+
+# Набор синтетических вакансий от свежих к старым, как в выдаче hh.ru
+def make_items(total, seed=1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone(timedelta(hours=3))).replace(microsecond=0)
+    return [make_item(i, now - timedelta(days=30) * (i + 0.5) / total, rnd) for i in range(total)]
+
+# Локальная замена api.hh.ru: постраничная выдача синтетических вакансий
+# с ограничением глубины 2000, фильтром по дате, задержкой и ошибками
+class FakeHH:
+    def __init__(self, total=5000, latency=0.0, error_rate=0.0, seed=1, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._rnd = random.Random(seed)
+        self.items = make_items(total, seed)
+        self._published = [datetime.strptime(item['published_at'], '%Y-%m-%dT%H:%M:%S%z') for item in self.items]
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def search(self, query):
+        items = self.items
+        if 'date_from' in query:
+            date_from = datetime.fromisoformat(query['date_from'])
+            date_to = datetime.fromisoformat(query['date_to']) if 'date_to' in query else None
+            items = [
+                item for item, published in zip(self.items, self._published)
+                if date_from <= published and (date_to is None or published <= date_to)
+            ]
+        per_page = int(query.get('per_page', 20))
+        page = int(query.get('page', 0))
+        if (page + 1) * per_page > MAX_DEPTH:
+            return 400, {'errors': [{'type': 'bad_argument', 'value': 'page'}]}
+        found = len(items)
+        return 200, {
+            'items': items[page * per_page:(page + 1) * per_page],
+            'found': found,
+            'pages': min(math.ceil(found / per_page), MAX_DEPTH // per_page),
+            'page': page,
+            'per_page': per_page,
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                    failed = fake._rnd.random() < fake.error_rate
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                if failed:
+                    status, body = 503, {'errors': [{'type': 'service_unavailable'}]}
+                elif url.path == '/vacancies':
+                    query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    status, body = fake.search(query)
+                else:
+                    status, body = 404, {'errors': [{'type': 'not_found'}]}
+                payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                if status == 503:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+# Запуск в отдельном процессе, чтобы сервер не влиял на замеры: адрес печатается первой строкой
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--total', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    fake = FakeHH(args.total, args.latency, args.error_rate, args.seed, args.port)
+    print(fake.url, flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
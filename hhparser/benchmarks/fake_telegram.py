@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+# Заглушка telegram.Bot: запоминает отправленные сообщения и документы
+class StubBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = []
+        self.documents = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages.append((chat_id, text))
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = document.read()
+        self.documents.append((chat_id, filename, len(content)))
+        return SimpleNamespace(chat_id=chat_id, filename=filename)
+
+# Сообщение, ответы которого уходят в StubBot
+class StubMessage:
+    def __init__(self, bot, chat_id, text=''):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        return await self.bot.send_document(self.chat_id, document, filename=filename, **kwargs)
+
+class StubCallbackQuery:
+    def __init__(self, message, data=''):
+        self.message = message
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.message.reply_text(text, **kwargs)
+
+# Update и CallbackContext с минимальным набором атрибутов, которые используют обработчики бота
+def make_update(bot, chat_id, text='', callback_data=None):
+    message = StubMessage(bot, chat_id, text)
+    callback_query = StubCallbackQuery(message, callback_data) if callback_data is not None else None
+    return SimpleNamespace(
+        message=None if callback_query else message,
+        callback_query=callback_query,
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id),
+    )
+
+def make_context(bot, user_data=None, args=None):
+    return SimpleNamespace(bot=bot, user_data=user_data or {}, args=args or [])
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tracemalloc
+import subprocess
+from fake_hh import make_items
+from fake_telegram import StubBot, make_update, make_context
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'telegram_bot')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+FAKE_HH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_hh.py')
+POSTGRES_IMAGE = 'postgres:13-alpine'
+BENCH_CHAT_ID = 1  # Чат, которому принадлежат вакансии в сценариях с базой
+
+# Процентиль методом ближайшего ранга
+def percentile(values, p):
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+# Прогон сценария: прогревочная итерация, задержки по итерациям
+# и пиковая память на отдельной итерации
+async def measure(name, func, iterations, items):
+    await func()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    await func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        'iterations': iterations,
+        'throughput': round(items * iterations / sum(latencies), 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'peak_kb': round(peak / 1024, 1),
+    }
+    print(f"{name:<32} {result['throughput']:>10} ед/с  p50 {result['p50_ms']:>9} мс  "
+          f"p99 {result['p99_ms']:>9} мс  память {result['peak_kb']:>9} КБ")
+    return result
+
+# Фальшивый api.hh.ru в отдельном процессе, возвращает процесс и адрес
+def start_fake_hh(args):
+    process = subprocess.Popen([
+        sys.executable, FAKE_HH_PATH, '--total', str(args.total),
+        '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+    ], stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+# Временный Postgres в Docker, контейнер удаляется после остановки
+def start_postgres():
+    if os.getenv('BENCH_POSTGRES_HOST'):
+        os.environ['POSTGRES_HOST'] = os.environ['BENCH_POSTGRES_HOST']
+        os.environ['POSTGRES_PORT'] = os.getenv('BENCH_POSTGRES_PORT', '5432')
+        return None
+    if not shutil.which('docker'):
+        raise RuntimeError('Docker не найден, укажите BENCH_POSTGRES_HOST или используйте --no-db')
+
+    name = f'hhparser-bench-{os.getpid()}'
+    subprocess.run([
+        'docker', 'run', '-d', '--rm', '--name', name,
+        '-e', 'POSTGRES_DB=vacancies', '-e', 'POSTGRES_USER=postgres', '-e', 'POSTGRES_PASSWORD=postgres',
+        '-p', '127.0.0.1::5432', POSTGRES_IMAGE,
+    ], check=True, stdout=subprocess.DEVNULL)
+    port = subprocess.run(['docker', 'port', name, '5432'], check=True, capture_output=True, text=True).stdout
+    os.environ['POSTGRES_HOST'] = '127.0.0.1'
+    os.environ['POSTGRES_PORT'] = port.strip().splitlines()[0].rsplit(':', 1)[1]
+
+    import psycopg2
+    for _ in range(60):
+        try:
+            psycopg2.connect(host='127.0.0.1', port=os.environ['POSTGRES_PORT'], dbname='vacancies',
+                             user='postgres', password='postgres').close()
+            return name
+        except psycopg2.OperationalError:
+            time.sleep(1)
+    raise RuntimeError('Временный Postgres не запустился')
+
+def stop_postgres(name):
+    if name:
+        subprocess.run(['docker', 'stop', name], stdout=subprocess.DEVNULL)
+
+async def run_scenarios(args, items, with_db):
+    # Модули бота импортируются после настройки окружения, так как читают его при импорте
+    sys.path.insert(0, BOT_DIR)
+    import hh_parser
+    import telegram_bot
+    from cache import response_cache
+    from ratelimit import TokenBucket
+    from sender import sender
+    from database import run_db, init_db, close_pool, insert_vacancies, copy_vacancies, clear_vacancies
+
+    # Измеряется работа бота, а не ограничения частоты Telegram
+    sender.global_bucket = TokenBucket(1e9)
+    sender.chat_rate = sender.chat_burst = 1e9
+
+    vacancies = hh_parser.parse_items({'items': items})
+    results = {}
+    n = args.iterations
+
+    async def fetch_sync():
+        response_cache.clear()
+        hh_parser.fetch_vacancies('python', '1', count=500)
+
+    async def fetch_async(count):
+        response_cache.clear()
+        async for _ in hh_parser.fetch_vacancies_async('python', '1', count=count):
+            pass
+
+    async def perform_search():
+        response_cache.clear()
+        bot = StubBot()
+        context = make_context(bot, {'vacancy': 'python', 'region': '1', 'count': 200})
+        # Один и тот же чат: новый поиск заменяет результаты предыдущего в result_store
+        await telegram_bot.perform_search(make_update(bot, BENCH_CHAT_ID, callback_data='start_search'), context)
+
+    results['fetch_vacancies[500]'] = await measure('fetch_vacancies[500]', fetch_sync, n, 500)
+    results['fetch_vacancies_async[500]'] = await measure('fetch_vacancies_async[500]', lambda: fetch_async(500), n, 500)
+    if len(items) > hh_parser.MAX_DEPTH:
+        count = min(len(items), 3000)
+        results[f'fetch_vacancies_async[{count}]'] = await measure(
+            f'fetch_vacancies_async[{count}]', lambda: fetch_async(count), max(1, n // 5), count)
+    results['perform_search[200]'] = await measure('perform_search[200]', perform_search, n, 200)
+
+    if with_db:
+        await run_db(init_db)
+        batch = vacancies[:2000]
+
+        async def insert_new():
+            await run_db(clear_vacancies, BENCH_CHAT_ID)
+            await run_db(insert_vacancies, BENCH_CHAT_ID, batch)
+
+        async def insert_unchanged():
+            await run_db(insert_vacancies, BENCH_CHAT_ID, batch)
+
+        async def copy_new():
+            await run_db(clear_vacancies, BENCH_CHAT_ID)
+            await run_db(copy_vacancies, [(BENCH_CHAT_ID, v) for v in batch])
+
+        async def export_csv():
+            bot = StubBot()
+            await telegram_bot.export_to_csv(make_update(bot, BENCH_CHAT_ID, callback_data='export_csv'), make_context(bot))
+
+        results['insert_vacancies[2000]'] = await measure('insert_vacancies[2000]', insert_new, n, len(batch))
+        results['insert_vacancies_unchanged[2000]'] = await measure('insert_vacancies_unchanged[2000]', insert_unchanged, n, len(batch))
+        results['copy_vacancies[2000]'] = await measure('copy_vacancies[2000]', copy_new, n, len(batch))
+        await run_db(insert_vacancies, BENCH_CHAT_ID, vacancies)
+        results[f'export_to_csv[{len(vacancies)}]'] = await measure(f'export_to_csv[{len(vacancies)}]', export_csv, max(1, n // 5), len(vacancies))
+        await run_db(clear_vacancies, BENCH_CHAT_ID)
+        await run_db(close_pool)
+
+    await hh_parser.close_client()
+    return results
+
+# Сравнение с сохраненными результатами, возвращает список регрессий
+def compare(results, baselines, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baselines.get(name)
+        if not base:
+            continue
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50_ms']} -> {result['p50_ms']} мс")
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']} -> {result['p99_ms']} мс")
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {base['throughput']} -> {result['throughput']}")
+        if result['peak_kb'] > base['peak_kb'] * (1 + tolerance):
+            regressions.append(f"{name}: память {base['peak_kb']} -> {result['peak_kb']} КБ")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочные сценарии бота без api.hh.ru и Telegram')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--total', type=int, default=5000, help='количество вакансий в фальшивом api.hh.ru')
+    parser.add_argument('--latency', type=float, default=0.01, help='задержка ответа фальшивого api.hh.ru, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--no-db', action='store_true', help='пропустить сценарии с Postgres')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='сохранить результаты как базовые')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимое ухудшение относительно базовых результатов')
+    args = parser.parse_args()
+
+    fake, url = start_fake_hh(args)
+    os.environ['HH_API_URL'] = url
+    os.environ.setdefault('HH_RATE', '1000000')
+    os.environ.setdefault('HH_CACHE_DB', '0')
+    container = None
+    try:
+        if not args.no_db:
+            container = start_postgres()
+        results = asyncio.run(run_scenarios(args, make_items(args.total), with_db=not args.no_db))
+    finally:
+        fake.terminate()
+        fake.wait()
+        stop_postgres(container)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f'Базовые результаты сохранены в {args.baseline}')
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print('Регрессии относительно базовых результатов:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('Регрессий нет')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from hh_client import HHApiError, get_json
+from hh_parser import API_URL
+from database import SALARY_DIMENSIONS, copy_salaries
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_TTL = int(os.getenv('ANALYTICS_TTL', 600))  # Сколько секунд использовать загруженные данные
+ANALYTICS_CHUNK_SIZE = 200000  # Строк CSV, обрабатываемых за раз
+ANALYTICS_SPOOL_SIZE = 32 * 1024 * 1024  # Выгрузка больше этого размера уходит из памяти на диск
+RATES_TTL = 24 * 3600  # Как часто обновлять курсы валют
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# Курсы на случай недоступности справочника hh.ru: сколько единиц валюты в одном рубле
+DEFAULT_RATES = {
+    'RUR': 1.0,
+    'USD': 0.011,
+    'EUR': 0.0101,
+    'KZT': 5.5,
+    'BYR': 0.035,
+    'UAH': 0.45,
+    'UZS': 140.0,
+    'KGS': 0.95,
+    'AZN': 0.019,
+    'GEL': 0.03,
+}
+
+# Зарплатная аналитика по сохраненным вакансиям чата. Зарплаты выгружаются из секции чата
+# пачками, приводятся к рублям и хранятся в памяти как две колонки:
+# категория группировки и зарплата
+class SalaryAnalytics:
+    def __init__(self, ttl=ANALYTICS_TTL):
+        self.ttl = ttl
+        self._frames = {}
+        self._rates = None
+        self._rates_loaded = 0
+        # _lock защищает словари, загрузка данных блокирует только свою пару (чат, группировка).
+        # Блокировка загрузки хранится, пока ее ждет или держит хотя бы один поток: [lock, число потоков]
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._rates_lock = threading.Lock()
+
+    # Курсы валют из справочника api.hh.ru
+    def rates(self):
+        with self._rates_lock:
+            if self._rates is None or time.monotonic() - self._rates_loaded > RATES_TTL:
+                try:
+                    data = get_json(f'{API_URL}/dictionaries', {})
+                    self._rates = {c['code']: float(c['rate']) for c in data['currency'] if c.get('rate')}
+                except (HHApiError, KeyError, ValueError) as e:
+                    logger.warning('Не удалось получить курсы валют, используются курсы по умолчанию: %s', e)
+                    self._rates = dict(DEFAULT_RATES)
+                self._rates_loaded = time.monotonic()
+            return self._rates
+
+    # Зарплата в рублях: середина вилки или указанная граница
+    def _normalize(self, chunk, rates):
+        salary_from = chunk['salary_from'].to_numpy()
+        salary_to = chunk['salary_to'].to_numpy()
+        salary = np.where(np.isnan(salary_from) | np.isnan(salary_to),
+                          np.fmax(salary_from, salary_to), (salary_from + salary_to) / 2)
+        rate = chunk['currency'].map(rates).to_numpy(dtype=float, na_value=np.nan)
+        salary = salary / rate
+        valid = ~np.isnan(salary) & (salary > 0)
+        return pd.DataFrame({'key': chunk['key'].to_numpy()[valid], 'salary': salary[valid]})
+
+    def _load(self, chat_id, dimension):
+        rates = self.rates()
+        with tempfile.SpooledTemporaryFile(max_size=ANALYTICS_SPOOL_SIZE, mode='w+', encoding='utf-8', newline='') as file:
+            copy_salaries(chat_id, dimension, file)
+            file.seek(0)
+            reader = pd.read_csv(file, chunksize=ANALYTICS_CHUNK_SIZE, keep_default_na=False, na_values=[''],
+                                 dtype={'key': str, 'salary_from': float, 'salary_to': float, 'currency': str})
+            frames = [self._normalize(chunk, rates) for chunk in reader]
+        frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame({'key': [], 'salary': []})
+        frame['key'] = frame['key'].fillna('Не указано').astype('category')
+        return frame
+
+    # Данные чата по группировке, загружаются заново после истечения ttl
+    def frame(self, chat_id, dimension):
+        if dimension not in SALARY_DIMENSIONS:
+            raise ValueError(f'Неизвестная группировка: {dimension}')
+        key = (chat_id, dimension)
+        with self._lock:
+            now = time.monotonic()
+            # Данные чатов, которые давно не запрашивали аналитику, не держатся в памяти
+            for expired in [k for k, (loaded, _) in self._frames.items() if now - loaded > self.ttl]:
+                del self._frames[expired]
+            entry = self._load_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                with self._lock:
+                    cached = self._frames.get(key)
+                if cached is None:
+                    cached = (time.monotonic(), self._load(chat_id, dimension))
+                    with self._lock:
+                        self._frames[key] = cached
+                return cached[1]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._load_locks[key]
+
+    # Сброс данных одного чата или всех чатов
+    def invalidate(self, chat_id=None):
+        with self._lock:
+            if chat_id is None:
+                self._frames.clear()
+            else:
+                for key in [key for key in self._frames if key[0] == chat_id]:
+                    del self._frames[key]
+
+    # Количество вакансий и процентили зарплаты по группам, самые многочисленные группы первыми
+    def stats(self, chat_id, dimension, min_count=1, limit=None):
+        frame = self.frame(chat_id, dimension)
+        if frame.empty:
+            return pd.DataFrame(columns=['count'] + [f'p{round(q * 100)}' for q in QUANTILES])
+        grouped = frame.groupby('key', observed=True)['salary']
+        result = grouped.quantile(list(QUANTILES)).unstack()
+        result.columns = [f'p{round(q * 100)}' for q in QUANTILES]
+        result.insert(0, 'count', grouped.size())
+        result = result[result['count'] >= min_count].sort_values('count', ascending=False)
+        return result.head(limit) if limit else result
+
+    # Гистограмма зарплат по всем вакансиям или по одной группе.
+    # Выбросы выше 99-го процентиля объединяются в последний интервал
+    def histogram(self, chat_id, dimension, value=None, bins=10):
+        frame = self.frame(chat_id, dimension)
+        if value is not None:
+            matches = [key for key in frame['key'].cat.categories if key.lower() == value.lower()]
+            frame = frame[frame['key'].isin(matches)]
+        salaries = frame['salary'].to_numpy()
+        if not len(salaries):
+            return np.array([], dtype=int), np.array([])
+        upper = np.percentile(salaries, 99)
+        return np.histogram(np.minimum(salaries, upper), bins=bins, range=(salaries.min(), upper))
+
+salary_analytics = SalaryAnalytics()
+
+def format_rub(value):
+    return f'{value:,.0f}'.replace(',', ' ') + ' ₽'
+
+# Текст отчета для команды /salary: процентили по группам или гистограмма одной группы
+def salary_report(chat_id, dimension, value=None, limit=15, min_count=3):
+    if value is None:
+        table = salary_analytics.stats(chat_id, dimension, min_count=min_count, limit=limit)
+        return [
+            f"{key}: {int(row['count'])} вак., медиана {format_rub(row['p50'])}, "
+            f"25–75%: {format_rub(row['p25'])} – {format_rub(row['p75'])}"
+            for key, row in table.iterrows()
+        ]
+
+    counts, edges = salary_analytics.histogram(chat_id, dimension, value)
+    if not len(counts):
+        return []
+    width = max(counts.max(), 1)
+    lines = [f'{value}: {counts.sum()} вак.']
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        lines.append(f"{format_rub(low)} – {format_rub(high)}: {'█' * round(count / width * 20)} {count}")
+    return lines
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+import psycopg2
+from database import get_connection
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = int(os.getenv('HH_CACHE_TTL', 600))  # Время жизни ответа в секундах
+CACHE_SIZE = int(os.getenv('HH_CACHE_SIZE', 1000))  # Максимальное количество ответов в памяти
+CACHE_DB = os.getenv('HH_CACHE_DB', '0') == '1'  # Второй уровень кэша в Postgres
+
+# Ключ кэша из нормализованных параметров запроса
+def make_key(params):
+    normalized = {k: str(v) for k, v in params.items() if v is not None}
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+
+# Кэш ответов api.hh.ru с TTL и вытеснением по LRU
+class ResponseCache:
+    def __init__(self, ttl=CACHE_TTL, maxsize=CACHE_SIZE, use_db=CACHE_DB):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.use_db = use_db
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return data
+
+    def _set_memory(self, key, data, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), data)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    # Ошибки Postgres не ломают поиск, кэш просто работает только в памяти
+    def _get_db(self, key):
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        'SELECT data, EXTRACT(EPOCH FROM expires_at - now()) FROM response_cache WHERE key = %s AND expires_at > now()',
+                        (key,)
+                    )
+                    return cur.fetchone()
+        except psycopg2.Error as e:
+            logger.warning('Ошибка чтения кэша из базы данных: %s', e)
+            return None
+
+    def _set_db(self, key, data):
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('''
+                        INSERT INTO response_cache (key, data, expires_at) VALUES (%s, %s, now() + %s * interval '1 second')
+                        ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                    ''', (key, json.dumps(data), self.ttl))
+        except psycopg2.Error as e:
+            logger.warning('Ошибка записи кэша в базу данных: %s', e)
+
+    def get(self, params):
+        key = make_key(params)
+        data = self._get_memory(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if self.use_db:
+            row = self._get_db(key)
+            if row:
+                self.db_hits += 1
+                data, ttl = row
+                self._set_memory(key, data, float(ttl))
+                return data
+        self.misses += 1
+        return None
+
+    def set(self, params, data):
+        key = make_key(params)
+        self._set_memory(key, data)
+        if self.use_db:
+            self._set_db(key, data)
+
+    # Асинхронные варианты, обращения к Postgres выполняются в отдельном потоке
+    async def aget(self, params):
+        key = make_key(params)
+        data = self._get_memory(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if self.use_db:
+            row = await asyncio.to_thread(self._get_db, key)
+            if row:
+                self.db_hits += 1
+                data, ttl = row
+                self._set_memory(key, data, float(ttl))
+                return data
+        self.misses += 1
+        return None
+
+    async def aset(self, params, data):
+        key = make_key(params)
+        self._set_memory(key, data)
+        if self.use_db:
+            await asyncio.to_thread(self._set_db, key, data)
+
+    # Удаление устаревших записей из памяти и из базы, вызывается периодической задачей
+    def _purge(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, (expires_at, _) in self._data.items() if expires_at < now]:
+                del self._data[key]
+        if not self.use_db:
+            return 0
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('DELETE FROM response_cache WHERE expires_at < now()')
+                    return cur.rowcount
+        except psycopg2.Error as e:
+            logger.warning('Ошибка очистки кэша в базе данных: %s', e)
+            return 0
+
+    async def purge_expired(self):
+        return await asyncio.to_thread(self._purge)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # Счетчики попаданий и промахов
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        return {
+            'hits': self.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'size': size,
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,57 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from database import iter_vacancies
+
+COLUMNAR_BATCH_SIZE = 50000  # Строк в одной группе строк Parquet или пакете Arrow
+COMPRESSION = 'zstd'
+
+# Колонки выгрузки: имя, выражение SQL и тип Arrow.
+# Зарплата разбирается на типизированные колонки, роли и ключевые навыки остаются списками
+EXPORT_FIELDS = (
+    ('hh_id', 'hh_id', pa.string()),
+    ('published_at', 'published_at', pa.timestamp('us', tz='UTC')),
+    ('name', 'name', pa.string()),
+    ('area', 'area', pa.string()),
+    ('salary_from', "(salary->>'from')::numeric::bigint", pa.int64()),
+    ('salary_to', "(salary->>'to')::numeric::bigint", pa.int64()),
+    ('salary_currency', "salary->>'currency'", pa.string()),
+    ('salary_gross', "(salary->>'gross')::boolean", pa.bool_()),
+    ('experience', 'experience', pa.string()),
+    ('employment', 'employment', pa.string()),
+    ('schedule', 'schedule', pa.string()),
+    ('professional_roles', 'professional_roles', pa.list_(pa.string())),
+    ('snippet', 'snippet', pa.string()),
+    ('employer', 'employer', pa.string()),
+    ('url', 'url', pa.string()),
+    ('description', 'description', pa.string()),
+    ('key_skills', 'key_skills', pa.list_(pa.string())),
+    ('address', 'address', pa.string()),
+)
+# Подробности есть только у вакансий, для которых они были загружены, и общие для всех чатов
+EXPORT_SOURCE = 'vacancies LEFT JOIN vacancy_details USING (hh_id)'
+SCHEMA = pa.schema([(name, arrow_type) for name, _, arrow_type in EXPORT_FIELDS])
+EXPORT_EXPRESSIONS = [expression for _, expression, _ in EXPORT_FIELDS]
+
+_zstd = pa.Codec(COMPRESSION)
+
+# Пачка строк курсора в колоночный пакет Arrow
+def to_record_batch(rows):
+    columns = zip(*rows)
+    return pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+
+# Запись вакансий чата в Parquet или Arrow IPC (format - 'parquet' или 'arrow').
+# Каждая пачка курсора становится отдельной группой строк, вся выгрузка в памяти не собирается
+def write_columnar(file, format, chat_id, filters=None, batch_size=COLUMNAR_BATCH_SIZE):
+    if format == 'parquet':
+        writer = pq.ParquetWriter(file, SCHEMA, compression=COMPRESSION)
+    else:
+        writer = pa.ipc.new_file(file, SCHEMA, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION))
+    try:
+        for rows in iter_vacancies(chat_id, batch_size, EXPORT_EXPRESSIONS, EXPORT_SOURCE, **(filters or {})):
+            writer.write_batch(to_record_batch(rows))
+    finally:
+        writer.close()
+
+# Сжатие части файла в отдельный кадр zstd, последовательность кадров читается как один файл
+def compress_zstd(data):
+    return _zstd.compress(data, asbytes=True)
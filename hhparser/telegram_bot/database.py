@@ -1,28 +1,34 @@
+import io
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
-import json
+import psycopg2.pool
+from metrics import timed, db_operation_seconds, rows_inserted
 
-DB_HOST = "database"
-DB_PORT = "5432"
-DB_NAME = "vacancies"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
+logger = logging.getLogger(__name__)
 
-# Подключение к базе данных
-def get_connection():
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-
-# Создание таблицы
-def create_table():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
+DB_HOST = os.getenv("POSTGRES_HOST", "database")
+DB_PORT = os.getenv("POSTGRES_PORT", "5432")
+DB_NAME = os.getenv("POSTGRES_DB", "vacancies")
+DB_USER = os.getenv("POSTGRES_USER", "postgres")
+DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
+DB_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", 10))
+EXPORT_BATCH_SIZE = 2000  # Количество строк, читаемых серверным курсором за раз
+FIND_PAGE_SIZE = 10  # Количество вакансий на странице результатов /find
+CHAT_EXPORT_PAGE_SIZE = 200  # Количество вакансий, читаемых за раз при экспорте в чат
+
+VACANCY_COLUMNS = ('name', 'area', 'salary', 'experience', 'employment', 'schedule', 'professional_roles', 'snippet', 'employer', 'url')
+
+# Миграции схемы, применяются по порядку один раз при запуске
+MIGRATIONS = [
+    '''
         CREATE TABLE IF NOT EXISTS vacancies (
             id SERIAL PRIMARY KEY,
             name TEXT,
@@ -36,37 +42,616 @@ def create_table():
             employer TEXT,
             url TEXT
         )
-    ''')
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# Вставка вакансий
-def insert_vacancies(vacancies):
-    conn = get_connection()
-    cur = conn.cursor()
-    psycopg2.extras.execute_values(cur, '''
-        INSERT INTO vacancies (name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url) VALUES %s
-    ''', [(v['name'], v['area'], json.dumps(v['salary']), v['experience'], v['employment'], v['schedule'], v['professional_roles'], v['snippet'], v['employer'], v['url']) for v in vacancies])
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# Функция для вытаскивания вакансий
-def fetch_all_vacancies():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url FROM vacancies')
-    vacancies = cur.fetchall()
-    cur.close()
-    conn.close()
-    return vacancies
-
-# Очистка таблицы
-def clear_table():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('TRUNCATE TABLE vacancies')
-    conn.commit()
-    cur.close()
-    conn.close()
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            data JSONB,
+            expires_at TIMESTAMPTZ
+        )
+    ''',
+    # Идентификатор вакансии hh.ru как естественный ключ, старые дубликаты удаляются
+    '''
+        ALTER TABLE vacancies
+            ADD COLUMN IF NOT EXISTS hh_id TEXT,
+            ADD COLUMN IF NOT EXISTS published_at TIMESTAMPTZ;
+        UPDATE vacancies SET hh_id = substring(url from '/vacancy/([0-9]+)') WHERE hh_id IS NULL;
+        DELETE FROM vacancies a USING vacancies b WHERE a.hh_id = b.hh_id AND a.id < b.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS vacancies_hh_id_idx ON vacancies (hh_id);
+    ''',
+    # Индексы для поиска по сохраненным вакансиям
+    '''
+        ALTER TABLE vacancies ADD COLUMN IF NOT EXISTS search_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('russian', coalesce(name, '') || ' ' || coalesce(snippet, ''))) STORED;
+        CREATE INDEX IF NOT EXISTS vacancies_search_idx ON vacancies USING GIN (search_tsv);
+        CREATE INDEX IF NOT EXISTS vacancies_salary_from_idx ON vacancies (((salary->>'from')::numeric));
+        CREATE INDEX IF NOT EXISTS vacancies_salary_to_idx ON vacancies (((salary->>'to')::numeric));
+        CREATE INDEX IF NOT EXISTS vacancies_roles_idx ON vacancies USING GIN (professional_roles);
+    ''',
+    # Сохраненные поиски, high_water - время публикации самой свежей найденной вакансии
+    '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            query JSONB NOT NULL,
+            high_water TIMESTAMPTZ NOT NULL DEFAULT now(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS subscriptions_chat_id_idx ON subscriptions (chat_id);
+    ''',
+    # Несохраненные результаты поиска, вытесненные из памяти бота
+    '''
+        CREATE TABLE IF NOT EXISTS pending_results (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            vacancy JSONB NOT NULL,
+            stored_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS pending_results_user_id_idx ON pending_results (user_id);
+    ''',
+    # Зарплаты в числовом виде для аналитики, обновляется через REFRESH ... CONCURRENTLY
+    '''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS vacancy_salaries AS
+            SELECT id, area, experience, employer, professional_roles,
+                (salary->>'from')::float8 AS salary_from,
+                (salary->>'to')::float8 AS salary_to,
+                salary->>'currency' AS currency
+            FROM vacancies
+            WHERE salary->>'currency' IS NOT NULL;
+        CREATE UNIQUE INDEX IF NOT EXISTS vacancy_salaries_id_idx ON vacancy_salaries (id);
+    ''',
+    # Подробности вакансий из GET /vacancies/{id} и валидаторы для условных запросов
+    '''
+        CREATE TABLE IF NOT EXISTS vacancy_details (
+            hh_id TEXT PRIMARY KEY,
+            description TEXT,
+            key_skills TEXT[],
+            address TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            checked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    ''',
+    # Состояние бота (user_data и состояния диалогов), общее для всех процессов
+    '''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        );
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+            PRIMARY KEY (name, key)
+        );
+    ''',
+    # Вакансии принадлежат чату и секционированы по хешу chat_id на 16 постоянных секций, чтение, экспорт
+    # и очистка чата затрагивают только его секцию, а DDL во время работы не нужен. Очистка - DELETE по
+    # (chat_id, id) с блокировкой только строк чата, место освобождает более частая автоочистка секций.
+    # Старые вакансии без владельца получают chat_id = 0, их может забрать администратор командой /claim
+    '''
+        DROP MATERIALIZED VIEW IF EXISTS vacancy_salaries;
+        ALTER TABLE vacancies RENAME TO vacancies_unpartitioned;
+        ALTER SEQUENCE vacancies_id_seq RENAME TO vacancies_unpartitioned_id_seq;
+        ALTER INDEX vacancies_pkey RENAME TO vacancies_unpartitioned_pkey;
+        CREATE TABLE vacancies (
+            id BIGSERIAL,
+            chat_id BIGINT NOT NULL,
+            hh_id TEXT,
+            published_at TIMESTAMPTZ,
+            name TEXT,
+            area TEXT,
+            salary JSONB,
+            experience TEXT,
+            employment TEXT,
+            schedule TEXT,
+            professional_roles TEXT[],
+            snippet TEXT,
+            employer TEXT,
+            url TEXT,
+            search_tsv tsvector GENERATED ALWAYS AS (to_tsvector('russian', coalesce(name, '') || ' ' || coalesce(snippet, ''))) STORED,
+            PRIMARY KEY (chat_id, id)
+        ) PARTITION BY HASH (chat_id);
+        DO $$
+        BEGIN
+            FOR i IN 0..15 LOOP
+                EXECUTE format('CREATE TABLE vacancies_p%s PARTITION OF vacancies FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i);
+                EXECUTE format('ALTER TABLE vacancies_p%s SET (autovacuum_vacuum_scale_factor = 0.02, autovacuum_vacuum_threshold = 1000)', i);
+            END LOOP;
+        END $$;
+        INSERT INTO vacancies (chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url)
+            SELECT 0, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url
+            FROM vacancies_unpartitioned ORDER BY id;
+        DROP TABLE vacancies_unpartitioned;
+        CREATE UNIQUE INDEX vacancies_hh_id_idx ON vacancies (chat_id, hh_id);
+        CREATE INDEX vacancies_search_idx ON vacancies USING GIN (search_tsv);
+        CREATE INDEX vacancies_salary_from_idx ON vacancies (chat_id, ((salary->>'from')::numeric));
+        CREATE INDEX vacancies_salary_to_idx ON vacancies (chat_id, ((salary->>'to')::numeric));
+        CREATE INDEX vacancies_roles_idx ON vacancies USING GIN (professional_roles);
+    ''',
+    # Удаление устаревших ответов из кэша (см. ResponseCache.purge_expired) идет по индексу
+    '''
+        CREATE INDEX IF NOT EXISTS response_cache_expires_at_idx ON response_cache (expires_at);
+    ''',
+    # Верхняя граница зарплаты в /find сравнивается с нижней границей вакансии, а если ее нет - с верхней
+    '''
+        CREATE INDEX IF NOT EXISTS vacancies_salary_low_idx ON vacancies
+            (chat_id, (salary->>'currency'), (COALESCE((salary->>'from')::numeric, (salary->>'to')::numeric)));
+    ''',
+    # Отметка о вакансиях, удаленных с hh.ru (404), чтобы они больше не запрашивались
+    '''
+        ALTER TABLE vacancy_details ADD COLUMN IF NOT EXISTS gone BOOLEAN NOT NULL DEFAULT false;
+    ''',
+]
+
+
+# Группировки зарплатной аналитики: вакансия с несколькими ролями учитывается в каждой
+SALARY_DIMENSIONS = {
+    'role': 'unnest(professional_roles)',
+    'area': 'area',
+    'experience': 'experience',
+    'employer': 'employer',
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+# Ограничивает число потоков, одновременно держащих соединение,
+# иначе ThreadedConnectionPool выбрасывает PoolError вместо ожидания
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# Пул соединений создается при первом обращении
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD
+                )
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+# Подключение к базе данных из пула, транзакция фиксируется при выходе из блока
+@contextmanager
+def get_connection():
+    with _pool_slots:
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+# Выполнение блокирующей функции базы данных вне цикла событий бота
+async def run_db(func, *args, **kwargs):
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+# Создание и миграция схемы, вызывается один раз при запуске
+@timed(db_operation_seconds, operation='init_db')
+def init_db(attempts=10, delay=2):
+    for attempt in range(1, attempts + 1):
+        try:
+            get_pool()
+            break
+        except psycopg2.OperationalError:
+            if attempt == attempts:
+                raise
+            logger.info('База данных недоступна, повторная попытка через %s с', delay)
+            time.sleep(delay)
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Блокировка защищает от одновременной миграции из нескольких процессов
+            cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', ('schema_migrations',))
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TIMESTAMPTZ DEFAULT now()
+                )
+            ''')
+            cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+            current = cur.fetchone()[0]
+            for version, sql in enumerate(MIGRATIONS, start=1):
+                if version > current:
+                    cur.execute(sql)
+                    cur.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (version,))
+                    logger.info('Применена миграция %s', version)
+
+# Вставка вакансий чата, уже сохраненные обновляются только если вакансия изменилась на hh.ru
+@timed(db_operation_seconds, operation='insert_vacancies')
+def insert_vacancies(chat_id, vacancies):
+    # В одном INSERT ... ON CONFLICT ключ не может повторяться
+    unique = {v.get('id') or id(v): v for v in vacancies}.values()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            changed = psycopg2.extras.execute_values(cur, '''
+                INSERT INTO vacancies (chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url) VALUES %s
+                ON CONFLICT (chat_id, hh_id) DO UPDATE SET
+                    published_at = EXCLUDED.published_at,
+                    name = EXCLUDED.name,
+                    area = EXCLUDED.area,
+                    salary = EXCLUDED.salary,
+                    experience = EXCLUDED.experience,
+                    employment = EXCLUDED.employment,
+                    schedule = EXCLUDED.schedule,
+                    professional_roles = EXCLUDED.professional_roles,
+                    snippet = EXCLUDED.snippet,
+                    employer = EXCLUDED.employer,
+                    url = EXCLUDED.url
+                WHERE (vacancies.published_at, vacancies.name, vacancies.area, vacancies.salary, vacancies.experience, vacancies.employment,
+                       vacancies.schedule, vacancies.professional_roles, vacancies.snippet, vacancies.employer, vacancies.url)
+                    IS DISTINCT FROM (EXCLUDED.published_at, EXCLUDED.name, EXCLUDED.area, EXCLUDED.salary, EXCLUDED.experience, EXCLUDED.employment,
+                       EXCLUDED.schedule, EXCLUDED.professional_roles, EXCLUDED.snippet, EXCLUDED.employer, EXCLUDED.url)
+                RETURNING (xmax = 0)
+            ''', [(chat_id, v.get('id'), v.get('published_at'), v['name'], v['area'], json.dumps(v['salary']), v['experience'], v['employment'], v['schedule'], v['professional_roles'], v['snippet'], v['employer'], v['url']) for v in unique], page_size=1000, fetch=True)
+    # xmax = 0 у новых строк, у обновленных существующих xmax заполнен
+    inserted = sum(1 for (is_new,) in changed if is_new)
+    rows_inserted.inc(inserted, kind='inserted')
+    rows_inserted.inc(len(changed) - inserted, kind='updated')
+
+# Экранирование значения для COPY в текстовом формате
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Литерал массива Postgres для колонки TEXT[]
+def _array_literal(values):
+    return '{' + ','.join('"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"' for v in values) + '}'
+
+# Массовая загрузка вакансий разных чатов, items - пары (chat_id, вакансия).
+# Строки передаются через COPY во временную таблицу и переносятся в vacancies
+# одним INSERT ... SELECT с той же логикой обновления, что в insert_vacancies
+@timed(db_operation_seconds, operation='copy_vacancies')
+def copy_vacancies(items):
+    unique = {(chat_id, v.get('id') or id(v)): (chat_id, v) for chat_id, v in items}.values()
+    buffer = io.StringIO()
+    for chat_id, v in unique:
+        row = (chat_id, v.get('id'), v.get('published_at'), v['name'], v['area'], json.dumps(v['salary']), v['experience'], v['employment'], v['schedule'], _array_literal(v['professional_roles']), v['snippet'], v['employer'], v['url'])
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Временная таблица живет, пока соединение находится в пуле, и очищается после каждой транзакции
+            cur.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS vacancies_staging (
+                    chat_id BIGINT,
+                    hh_id TEXT,
+                    published_at TIMESTAMPTZ,
+                    name TEXT,
+                    area TEXT,
+                    salary JSONB,
+                    experience TEXT,
+                    employment TEXT,
+                    schedule TEXT,
+                    professional_roles TEXT[],
+                    snippet TEXT,
+                    employer TEXT,
+                    url TEXT
+                ) ON COMMIT DELETE ROWS
+            ''')
+            cur.copy_expert('COPY vacancies_staging (chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url) FROM STDIN', buffer)
+            cur.execute('''
+                INSERT INTO vacancies (chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url)
+                SELECT chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url FROM vacancies_staging
+                ON CONFLICT (chat_id, hh_id) DO UPDATE SET
+                    published_at = EXCLUDED.published_at,
+                    name = EXCLUDED.name,
+                    area = EXCLUDED.area,
+                    salary = EXCLUDED.salary,
+                    experience = EXCLUDED.experience,
+                    employment = EXCLUDED.employment,
+                    schedule = EXCLUDED.schedule,
+                    professional_roles = EXCLUDED.professional_roles,
+                    snippet = EXCLUDED.snippet,
+                    employer = EXCLUDED.employer,
+                    url = EXCLUDED.url
+                WHERE (vacancies.published_at, vacancies.name, vacancies.area, vacancies.salary, vacancies.experience, vacancies.employment,
+                       vacancies.schedule, vacancies.professional_roles, vacancies.snippet, vacancies.employer, vacancies.url)
+                    IS DISTINCT FROM (EXCLUDED.published_at, EXCLUDED.name, EXCLUDED.area, EXCLUDED.salary, EXCLUDED.experience, EXCLUDED.employment,
+                       EXCLUDED.schedule, EXCLUDED.professional_roles, EXCLUDED.snippet, EXCLUDED.employer, EXCLUDED.url)
+                RETURNING (xmax = 0)
+            ''')
+            changed = cur.fetchall()
+    inserted = sum(1 for (is_new,) in changed if is_new)
+    rows_inserted.inc(inserted, kind='inserted')
+    rows_inserted.inc(len(changed) - inserted, kind='updated')
+
+# Проверка наличия сохраненных вакансий чата без чтения таблицы
+@timed(db_operation_seconds, operation='has_vacancies')
+def has_vacancies(chat_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT EXISTS (SELECT 1 FROM vacancies WHERE chat_id = %s)', (chat_id,))
+            return cur.fetchone()[0]
+
+# Потоковое чтение вакансий чата серверным курсором пачками по batch_size строк.
+# columns - выражения SELECT, source - таблица или соединение, filters - условия как в find_vacancies
+def iter_vacancies(chat_id, batch_size=EXPORT_BATCH_SIZE, columns=VACANCY_COLUMNS, source='vacancies', **filters):
+    conditions, params = build_filters(chat_id, **filters)
+    with get_connection() as conn:
+        with conn.cursor(name='vacancies_export') as cur:
+            cur.itersize = batch_size
+            cur.execute(f'SELECT {", ".join(columns)} FROM {source} WHERE {" AND ".join(conditions)} ORDER BY id', params)
+            while True:
+                started = time.perf_counter()
+                rows = cur.fetchmany(batch_size)
+                db_operation_seconds.observe(time.perf_counter() - started, operation='iter_vacancies')
+                if not rows:
+                    break
+                yield rows
+
+# Асинхронное чтение вакансий чата страницами по ключу id. Каждая страница - отдельный короткий
+# запрос, соединение и транзакция не удерживаются, пока страница медленно отправляется в чат
+async def aiter_vacancies(chat_id, batch_size=CHAT_EXPORT_PAGE_SIZE, **filters):
+    after_id = 0
+    while True:
+        rows = await run_db(find_vacancies, chat_id, after_id=after_id, limit=batch_size, **filters)
+        if rows:
+            after_id = rows[-1][0]
+            yield [row[1:] for row in rows]
+        if len(rows) < batch_size:
+            break
+
+# Условия фильтрации сохраненных вакансий чата. Условие на chat_id выбирает одну секцию,
+# остальные условия покрыты индексами
+def build_filters(chat_id, text=None, salary_min=None, salary_max=None, role=None):
+    conditions = ['chat_id = %s']
+    params = [chat_id]
+    if text:
+        conditions.append("search_tsv @@ websearch_to_tsquery('russian', %s)")
+        params.append(text)
+    # Диапазон зарплаты задается в рублях, вакансии в других валютах в него не попадают
+    if salary_min is not None or salary_max is not None:
+        conditions.append("salary->>'currency' = 'RUR'")
+    if salary_min is not None:
+        conditions.append("((salary->>'from')::numeric >= %s OR (salary->>'to')::numeric >= %s)")
+        params.extend([salary_min, salary_min])
+    if salary_max is not None:
+        conditions.append("COALESCE((salary->>'from')::numeric, (salary->>'to')::numeric) <= %s")
+        params.append(salary_max)
+    if role:
+        conditions.append('professional_roles @> ARRAY[%s]::text[]')
+        params.append(role)
+    return conditions, params
+
+# Поиск по сохраненным вакансиям с постраничным выводом по ключу id
+@timed(db_operation_seconds, operation='find_vacancies')
+def find_vacancies(chat_id, text=None, salary_min=None, salary_max=None, role=None, after_id=0, limit=FIND_PAGE_SIZE):
+    conditions, params = build_filters(chat_id, text, salary_min, salary_max, role)
+    conditions.append('id > %s')
+    params.append(after_id)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f'''
+                SELECT id, {", ".join(VACANCY_COLUMNS)} FROM vacancies
+                WHERE {" AND ".join(conditions)}
+                ORDER BY id
+                LIMIT %s
+            ''', params + [limit])
+            return cur.fetchall()
+
+# Сохранение поиска для периодического обновления
+@timed(db_operation_seconds, operation='add_subscription')
+def add_subscription(chat_id, query):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                'INSERT INTO subscriptions (chat_id, query) VALUES (%s, %s) RETURNING id',
+                (chat_id, json.dumps(query))
+            )
+            return cur.fetchone()[0]
+
+# Сохраненные поиски пользователя
+@timed(db_operation_seconds, operation='list_subscriptions')
+def list_subscriptions(chat_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, query, high_water FROM subscriptions WHERE chat_id = %s ORDER BY id', (chat_id,))
+            return cur.fetchall()
+
+# Удаление сохраненного поиска, возвращает True если поиск был найден
+@timed(db_operation_seconds, operation='delete_subscription')
+def delete_subscription(chat_id, subscription_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('DELETE FROM subscriptions WHERE chat_id = %s AND id = %s', (chat_id, subscription_id))
+            return cur.rowcount > 0
+
+# Все сохраненные поиски для планировщика
+@timed(db_operation_seconds, operation='all_subscriptions')
+def all_subscriptions():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, chat_id, query, high_water FROM subscriptions ORDER BY id')
+            return cur.fetchall()
+
+# Сдвиг отметки последней найденной вакансии, отметка никогда не уменьшается
+@timed(db_operation_seconds, operation='update_high_water')
+def update_high_water(subscription_id, high_water):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                'UPDATE subscriptions SET high_water = GREATEST(high_water, %s) WHERE id = %s',
+                (high_water, subscription_id)
+            )
+
+# Валидаторы сохраненных подробностей: {hh_id: (etag, last_modified, секунд с последней проверки)}
+@timed(db_operation_seconds, operation='get_detail_validators')
+def get_detail_validators(hh_ids):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT hh_id, etag, last_modified, EXTRACT(EPOCH FROM now() - checked_at), gone FROM vacancy_details WHERE hh_id = ANY(%s)',
+                (list(hh_ids),)
+            )
+            return {hh_id: (etag, last_modified, float(age), gone) for hh_id, etag, last_modified, age, gone in cur.fetchall()}
+
+# Запись загруженных подробностей вакансий
+@timed(db_operation_seconds, operation='upsert_vacancy_details')
+def upsert_vacancy_details(details):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, '''
+                INSERT INTO vacancy_details (hh_id, description, key_skills, address, etag, last_modified) VALUES %s
+                ON CONFLICT (hh_id) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    key_skills = EXCLUDED.key_skills,
+                    address = EXCLUDED.address,
+                    etag = EXCLUDED.etag,
+                    last_modified = EXCLUDED.last_modified,
+                    fetched_at = now(),
+                    checked_at = now()
+            ''', [(d['hh_id'], d['description'], d['key_skills'], d['address'], d['etag'], d['last_modified']) for d in details], page_size=1000)
+
+# Отметка о проверке подробностей, которые не изменились
+@timed(db_operation_seconds, operation='touch_vacancy_details')
+def touch_vacancy_details(hh_ids):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('UPDATE vacancy_details SET checked_at = now() WHERE hh_id = ANY(%s)', (list(hh_ids),))
+
+# Отметка о вакансиях, которых больше нет на hh.ru. Ранее загруженные подробности сохраняются
+@timed(db_operation_seconds, operation='mark_vacancy_details_gone')
+def mark_vacancy_details_gone(hh_ids):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, '''
+                INSERT INTO vacancy_details (hh_id, gone) VALUES %s
+                ON CONFLICT (hh_id) DO UPDATE SET gone = true, checked_at = now()
+            ''', [(hh_id, True) for hh_id in hh_ids], page_size=1000)
+
+# user_data пользователя и состояние его диалога вместе со временем последней записи
+@timed(db_operation_seconds, operation='load_bot_state')
+def load_bot_state(user_id, name, key):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('''
+                SELECT u.data, u.updated_at, c.state, c.updated_at
+                FROM (SELECT 1) AS one
+                LEFT JOIN bot_user_data u ON u.user_id = %s
+                LEFT JOIN bot_conversations c ON c.name = %s AND c.key = %s
+            ''', (user_id, name, key))
+            return cur.fetchone()
+
+# Запись накопленных изменений состояния бота одной транзакцией.
+# users - {user_id: data}, conversations - {(name, key): state}, None в state означает конец диалога.
+# Возвращает время записи каждой строки
+@timed(db_operation_seconds, operation='save_bot_state')
+def save_bot_state(users, conversations):
+    versions = {}
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            if users:
+                rows = psycopg2.extras.execute_values(cur, '''
+                    INSERT INTO bot_user_data (user_id, data) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = clock_timestamp()
+                    RETURNING user_id, updated_at
+                ''', [(user_id, json.dumps(data)) for user_id, data in users.items()], fetch=True)
+                versions.update((('user', user_id), updated_at) for user_id, updated_at in rows)
+            if conversations:
+                rows = psycopg2.extras.execute_values(cur, '''
+                    INSERT INTO bot_conversations (name, key, state) VALUES %s
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = clock_timestamp()
+                    RETURNING name, key, updated_at
+                ''', [(name, key, json.dumps(state)) for (name, key), state in conversations.items()], fetch=True)
+                versions.update(((name, key), updated_at) for name, key, updated_at in rows)
+    return versions
+
+# Перенос несохраненных результатов поиска из памяти в базу
+@timed(db_operation_seconds, operation='insert_pending_results')
+def insert_pending_results(user_id, vacancies):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                'INSERT INTO pending_results (user_id, vacancy) VALUES %s',
+                [(user_id, json.dumps(v)) for v in vacancies],
+                page_size=1000
+            )
+
+# Чтение и удаление несохраненных результатов пользователя
+@timed(db_operation_seconds, operation='take_pending_results')
+def take_pending_results(user_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT vacancy FROM pending_results WHERE user_id = %s ORDER BY id', (user_id,))
+            vacancies = [row[0] for row in cur.fetchall()]
+            cur.execute('DELETE FROM pending_results WHERE user_id = %s', (user_id,))
+            return vacancies
+
+@timed(db_operation_seconds, operation='delete_pending_results')
+def delete_pending_results(user_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('DELETE FROM pending_results WHERE user_id = %s', (user_id,))
+
+# Удаление несохраненных результатов старше ttl секунд
+@timed(db_operation_seconds, operation='purge_pending_results')
+def purge_pending_results(ttl):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM pending_results WHERE stored_at < now() - %s * interval '1 second'", (ttl,))
+            return cur.rowcount
+
+# Выгрузка зарплат чата в CSV (key, salary_from, salary_to, currency) через COPY TO STDOUT.
+# Читается только секция чата, поэтому только что сохраненные вакансии сразу попадают в выгрузку
+@timed(db_operation_seconds, operation='copy_salaries')
+def copy_salaries(chat_id, dimension, file):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # COPY не принимает параметры, значение подставляется через mogrify
+            query = cur.mogrify(f'''
+                SELECT {SALARY_DIMENSIONS[dimension]} AS key,
+                    (salary->>'from')::float8 AS salary_from,
+                    (salary->>'to')::float8 AS salary_to,
+                    salary->>'currency' AS currency
+                FROM vacancies
+                WHERE chat_id = %s AND salary->>'currency' IS NOT NULL
+            ''', (chat_id,)).decode('utf-8')
+            cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+
+# Удаление вакансий чата: DELETE по индексу в секции чата, строки других чатов не блокируются
+@timed(db_operation_seconds, operation='clear_vacancies')
+def clear_vacancies(chat_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('DELETE FROM vacancies WHERE chat_id = %s', (chat_id,))
+            return cur.rowcount
+
+# Перенос вакансий без владельца (chat_id = 0) в чат, уже сохраненные в чате не дублируются
+@timed(db_operation_seconds, operation='claim_legacy_vacancies')
+def claim_legacy_vacancies(chat_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO vacancies (chat_id, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url)
+                SELECT %s, hh_id, published_at, name, area, salary, experience, employment, schedule, professional_roles, snippet, employer, url
+                FROM vacancies WHERE chat_id = 0 ORDER BY id
+                ON CONFLICT (chat_id, hh_id) DO NOTHING
+            ''', (chat_id,))
+            claimed = cur.rowcount
+            cur.execute('DELETE FROM vacancies WHERE chat_id = 0')
+            return claimed
@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from hh_client import HHApiError, HHRequestError, arequest
+from hh_parser import URL
+from database import run_db, get_detail_validators, upsert_vacancy_details, touch_vacancy_details, mark_vacancy_details_gone
+from metrics import vacancy_details
+
+logger = logging.getLogger(__name__)
+
+HH_DETAILS = os.getenv('HH_DETAILS', '0') == '1'  # Загружать подробности сохраненных вакансий
+DETAILS_CONCURRENCY = int(os.getenv('HH_DETAILS_CONCURRENCY', 5))  # Сколько вакансий запрашивать одновременно
+DETAILS_TTL = int(os.getenv('HH_DETAILS_TTL', 24 * 3600))  # Сколько секунд не перепроверять подробности
+DETAILS_BATCH_SIZE = 500  # Сколько подробностей записывать в базу за раз
+
+# Нужные поля из ответа GET /vacancies/{id}
+def parse_detail(hh_id, data, etag=None, last_modified=None):
+    address = data.get('address') or {}
+    return {
+        'hh_id': hh_id,
+        'description': data.get('description') or '',
+        'key_skills': [skill['name'] for skill in data.get('key_skills') or []],
+        'address': address.get('raw'),
+        'etag': etag,
+        'last_modified': last_modified,
+    }
+
+# Условный запрос подробностей одной вакансии.
+# Возвращает разобранные подробности, None если вакансия не изменилась, или 'gone' если ее больше нет
+async def fetch_detail(hh_id, etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = await arequest(f'{URL}/{hh_id}', headers=headers)
+    except HHRequestError as e:
+        if e.status == 404:
+            return 'gone'
+        raise
+    if response.status_code == 304:
+        return None
+    return parse_detail(hh_id, response.json(), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+# Загрузка подробностей для набора вакансий с ограничением числа одновременных запросов.
+# Недавно проверенные и удаленные с hh.ru пропускаются, остальные перепроверяются условным запросом
+async def enrich_vacancies(vacancies, concurrency=DETAILS_CONCURRENCY, ttl=DETAILS_TTL):
+    hh_ids = list(dict.fromkeys(v['id'] for v in vacancies if v.get('id')))
+    counts = {'fetched': 0, 'not_modified': 0, 'fresh': 0, 'gone': 0, 'failed': 0}
+    if not hh_ids:
+        return counts
+
+    validators = await run_db(get_detail_validators, hh_ids)
+    semaphore = asyncio.Semaphore(concurrency)
+    details, unchanged, gone = [], [], []
+
+    async def enrich(hh_id):
+        etag, last_modified, age, is_gone = validators.get(hh_id, (None, None, None, False))
+        if is_gone or age is not None and age < ttl:
+            counts['fresh'] += 1
+            return
+        async with semaphore:
+            try:
+                detail = await fetch_detail(hh_id, etag, last_modified)
+            except HHApiError as e:
+                logger.warning('Не удалось загрузить подробности вакансии %s: %s', hh_id, e)
+                counts['failed'] += 1
+                return
+        if detail == 'gone':
+            counts['gone'] += 1
+            gone.append(hh_id)
+        elif detail is None:
+            counts['not_modified'] += 1
+            unchanged.append(hh_id)
+        else:
+            counts['fetched'] += 1
+            details.append(detail)
+
+    for start in range(0, len(hh_ids), DETAILS_BATCH_SIZE):
+        await asyncio.gather(*(enrich(hh_id) for hh_id in hh_ids[start:start + DETAILS_BATCH_SIZE]))
+        if details:
+            await run_db(upsert_vacancy_details, details)
+            details.clear()
+        if unchanged:
+            await run_db(touch_vacancy_details, unchanged)
+            unchanged.clear()
+        if gone:
+            await run_db(mark_vacancy_details_gone, gone)
+            gone.clear()
+
+    for result, count in counts.items():
+        vacancy_details.inc(count, result=result)
+    return counts
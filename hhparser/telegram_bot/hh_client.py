@@ -0,0 +1,205 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from ratelimit import TokenBucket
+from metrics import hh_request_seconds, hh_pages_fetched
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 5  # Секунды на установку соединения
+READ_TIMEOUT = 15  # Секунды на ожидание ответа
+MAX_RETRIES = 4  # Повторы после первой неудачной попытки
+BACKOFF_BASE = 0.5  # Начальная задержка повтора, секунды
+BACKOFF_MAX = 30  # Максимальная задержка повтора, секунды
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HH_RATE = float(os.getenv('HH_RATE', 10))  # Запросов в секунду к api.hh.ru на весь процесс
+BREAKER_THRESHOLD = 5  # Сколько неудач подряд размыкают цепь
+BREAKER_RESET = 30  # Через сколько секунд пробовать снова
+
+# Ошибка обращения к api.hh.ru после всех повторов
+class HHApiError(Exception):
+    pass
+
+# Ошибка в самом запросе (4xx), повтор не поможет
+class HHRequestError(HHApiError):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+# Запросы не выполняются, пока api.hh.ru считается недоступным
+class CircuitOpenError(HHApiError):
+    pass
+
+# Автомат защиты: после BREAKER_THRESHOLD неудач подряд запросы сразу отклоняются
+# на BREAKER_RESET секунд, затем пропускается один пробный запрос
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial:
+                raise CircuitOpenError('api.hh.ru временно недоступен')
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    # Запрос прерван без ответа (например, отменен): пробный запрос сможет выполнить следующий вызов
+    def abort_request(self):
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                if self.opened_at is None or self._trial:
+                    logger.warning('api.hh.ru недоступен, запросы приостановлены на %s с', self.reset_timeout)
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+breaker = CircuitBreaker()
+limiter = TokenBucket(HH_RATE)
+
+# Задержка перед повтором: Retry-After от сервера или экспонента со случайным разбросом
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+# Общий пул соединений для синхронных запросов
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20))
+            _session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=20))
+    return _session
+
+# Общий пул соединений для асинхронных запросов
+_client = None
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# GET-запрос к api.hh.ru с повторами, возвращает разобранный JSON
+def get_json(url, params=None):
+    error = None
+    for attempt in range(MAX_RETRIES + 1):
+        breaker.before_request()
+        retry_after = None
+        try:
+            limiter.acquire_sync()
+            started = time.perf_counter()
+            response = get_session().get(url, params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.RequestException as e:
+            hh_request_seconds.observe(time.perf_counter() - started, status='error')
+            error = e
+        except BaseException:
+            breaker.abort_request()
+            raise
+        else:
+            hh_request_seconds.observe(time.perf_counter() - started, status=str(response.status_code))
+            if response.status_code == 200:
+                breaker.record_success()
+                hh_pages_fetched.inc()
+                return response.json()
+            if response.status_code not in RETRY_STATUSES:
+                # Сервер отвечает, ошибка в самом запросе
+                breaker.record_success()
+                raise HHRequestError(f'api.hh.ru ответил {response.status_code}', response.status_code)
+            error = HHApiError(f'api.hh.ru ответил {response.status_code}')
+            retry_after = response.headers.get('Retry-After')
+        breaker.record_failure()
+        if attempt < MAX_RETRIES:
+            delay = retry_delay(attempt, retry_after)
+            logger.info('Повтор запроса к api.hh.ru через %.1f с: %r', delay, error)
+            time.sleep(delay)
+    raise HHApiError(f'api.hh.ru недоступен: {error}')
+
+# Асинхронный GET-запрос с повторами. Возвращает ответ 200 или 304,
+# если в headers переданы условия If-None-Match или If-Modified-Since
+async def arequest(url, params=None, headers=None):
+    client = get_client()
+    error = None
+    for attempt in range(MAX_RETRIES + 1):
+        breaker.before_request()
+        retry_after = None
+        try:
+            await limiter.acquire()
+            started = time.perf_counter()
+            response = await client.get(url, params=params, headers=headers)
+        except httpx.TransportError as e:
+            hh_request_seconds.observe(time.perf_counter() - started, status='error')
+            error = e
+        except BaseException:
+            # Отмена и прочие ошибки без ответа сервера не должны оставлять пробный запрос занятым
+            breaker.abort_request()
+            raise
+        else:
+            hh_request_seconds.observe(time.perf_counter() - started, status=str(response.status_code))
+            if response.status_code in (200, 304):
+                breaker.record_success()
+                return response
+            if response.status_code not in RETRY_STATUSES:
+                # Сервер отвечает, ошибка в самом запросе
+                breaker.record_success()
+                raise HHRequestError(f'api.hh.ru ответил {response.status_code}', response.status_code)
+            error = HHApiError(f'api.hh.ru ответил {response.status_code}')
+            retry_after = response.headers.get('Retry-After')
+        breaker.record_failure()
+        if attempt < MAX_RETRIES:
+            delay = retry_delay(attempt, retry_after)
+            logger.info('Повтор запроса к api.hh.ru через %.1f с: %r', delay, error)
+            await asyncio.sleep(delay)
+    raise HHApiError(f'api.hh.ru недоступен: {error}')
+
+async def aget_json(url, params=None):
+    response = await arequest(url, params)
+    hh_pages_fetched.inc()
+    return response.json()
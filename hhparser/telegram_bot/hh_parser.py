@@ -1,71 +1,331 @@
-import requests
+import os
+import math
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from cache import response_cache
+from hh_client import HHApiError, get_json, aget_json, close_client
+from metrics import vacancies_filtered
 
-# Функция для парсинга вакансий
-def fetch_vacancies(vacancy_name, region, count=10, salary=None, experience=None, employment=None, schedule=None):
-    url = "https://api.hh.ru/vacancies"
-    vacancies = []
-    page = 0
-    per_page = 50  # Максимальное количество вакансий за один запрос
-
-    # Преобразование параметров фильтра
-    experience_map = {
-        'Не имеет значения': None,
-        'Без опыта': 'noExperience',
-        'От 1 года до 3 лет': 'between1And3',
-        'От 3 до 6 лет': 'between3And6',
-        'Более 6 лет': 'moreThan6',
-    }
-    employment_map = {
-        'Полная занятость': 'full',
-        'Частичная занятость': 'part',
-        'Стажировка': 'probation',
+API_URL = os.getenv("HH_API_URL", "https://api.hh.ru")
+URL = f"{API_URL}/vacancies"
+PER_PAGE = 100  # Максимальное количество вакансий за один запрос
+MAX_DEPTH = 2000  # api.hh.ru отдает не больше 2000 вакансий на один запрос
+SEARCH_PERIOD = timedelta(days=30)  # За какой период api.hh.ru хранит вакансии
+MIN_WINDOW = timedelta(minutes=1)  # Окно по дате меньше этого не делится
+CONCURRENCY = 5  # Сколько страниц запрашивать одновременно, лимит общий для всех подзапросов одного поиска
+
+# Преобразование параметров фильтра
+experience_map = {
+    'Не имеет значения': None,
+    'Без опыта': 'noExperience',
+    'От 1 года до 3 лет': 'between1And3',
+    'От 3 до 6 лет': 'between3And6',
+    'Более 6 лет': 'moreThan6',
+}
+employment_map = {
+    'Полная занятость': 'full',
+    'Частичная занятость': 'part',
+    'Стажировка': 'probation',
+}
+schedule_map = {
+    'Полный день': 'fullDay',
+    'Сменный график': 'shift',
+    'Гибкий график': 'flexible',
+    'Удаленная работа': 'remote',
+}
+
+# Результат поиска: список вакансий и признак того, что часть страниц получить не удалось
+class SearchResult(list):
+    def __init__(self, vacancies=(), partial=False):
+        super().__init__(vacancies)
+        self.partial = partial
+
+# Часть страниц не удалось получить, уже отданные вакансии корректны
+class PartialResultsError(HHApiError):
+    pass
+
+# Подзапросы поиска по нескольким названиям и регионам: все сочетания (название, регион) без повторов.
+# vacancy_name и region - строка или список строк
+def expand_queries(vacancy_name, region):
+    names = [vacancy_name] if isinstance(vacancy_name, str) else vacancy_name
+    regions = [region] if isinstance(region, str) else region
+    return list(dict.fromkeys(itertools.product(names, regions)))
+
+# Параметры запроса к api.hh.ru, совпадение ищется только в названии вакансии
+def build_params(vacancy_name, region, salary=None, experience=None, employment=None, schedule=None):
+    params = {
+        'text': vacancy_name,
+        'search_field': 'name',
+        'area': region,
+        'per_page': PER_PAGE,
     }
-    schedule_map = {
-        'Полный день': 'fullDay',
-        'Сменный график': 'shift',
-        'Гибкий график': 'flexible',
-        'Удаленная работа': 'remote',
+    if salary:
+        params['salary_from'], params['salary_to'] = salary
+    if experience:
+        params['experience'] = experience_map.get(experience)
+    if employment:
+        params['employment'] = employment_map.get(employment)
+    if schedule:
+        params['schedule'] = schedule_map.get(schedule)
+    # Пустые значения не передаются, чтобы одинаковые запросы давали одинаковый ключ кэша
+    return {k: v for k, v in params.items() if v is not None}
+
+# Преобразование вакансий одной страницы
+def parse_items(data):
+    vacancies = []
+    for item in data['items']:
+        vacancies.append({
+            'id': item['id'],
+            'published_at': item.get('published_at'),
+            'name': item['name'],
+            'area': item['area']['name'],
+            'salary': item.get('salary'),
+            'experience': item['experience']['name'],
+            'employment': item['employment']['name'],
+            'schedule': item['schedule']['name'] if 'schedule' in item else '',
+            'professional_roles': [role['name'] for role in item['professional_roles']],
+            'snippet': item['snippet']['responsibility'] if item['snippet'] else '',
+            'url': item['alternate_url'],
+            'employer': item['employer']['name'] if 'employer' in item else 'Не указано'
+        })
+    return vacancies
+
+# Сколько страниц нужно запросить, чтобы получить count вакансий
+def plan_pages(data, count):
+    available = min(count, data.get('found', 0), MAX_DEPTH)
+    return min(data.get('pages', 0), math.ceil(available / PER_PAGE))
+
+# Нужно ли делить запрос по датам: нужных вакансий больше, чем отдает api.hh.ru
+def needs_split(data, count, date_from, date_to):
+    if data.get('found', 0) <= MAX_DEPTH or count <= MAX_DEPTH:
+        return False
+    return date_from is None or date_to - date_from > MIN_WINDOW
+
+# Параметры запроса, ограниченные окном по дате публикации
+def window_params(params, date_from, date_to):
+    if date_from is None:
+        return params
+    return {
+        **params,
+        'date_from': date_from.isoformat(timespec='seconds'),
+        'date_to': date_to.isoformat(timespec='seconds'),
     }
 
-    while len(vacancies) < count:
-        params = {
-            'text': vacancy_name,
-            'area': region,
-            'per_page': per_page,
-            'page': page
-        }
-        if salary:
-            params['salary_from'], params['salary_to'] = salary
-        if experience:
-            params['experience'] = experience_map.get(experience)
-        if employment:
-            params['employment'] = employment_map.get(employment)
-        if schedule:
-            params['schedule'] = schedule_map.get(schedule)
-
-        response = requests.get(url, params=params)
-        if response.status_code != 200:
+# Деление окна пополам, если окно не задано, берется весь период хранения вакансий
+def split_window(date_from, date_to):
+    if date_from is None:
+        date_to = datetime.now(timezone.utc).replace(microsecond=0)
+        date_from = date_to - SEARCH_PERIOD
+    middle = date_from + (date_to - date_from) / 2
+    # Сначала более свежие вакансии, как и в обычной выдаче
+    return [(middle, date_to), (date_from, middle)]
+
+# Страницы окон по дате не кэшируются: границы окна считаются от текущего времени,
+# поэтому ключ кэша меняется каждую секунду и повторно не используется
+def cacheable(params):
+    return 'date_from' not in params
+
+# Запрос одной страницы с учетом кэша
+def get_page(params, page):
+    params = {**params, 'page': page}
+    if not cacheable(params):
+        return get_json(URL, params)
+    data = response_cache.get(params)
+    if data is None:
+        data = get_json(URL, params)
+        response_cache.set(params, data)
+    return data
+
+# Выгрузка одного окна, при превышении лимита глубины окно делится по дате.
+# Если api.hh.ru недоступен, возвращается то, что успели получить, с признаком partial
+def fetch_window(params, count, date_from=None, date_to=None):
+    window = window_params(params, date_from, date_to)
+    vacancies = SearchResult()
+    try:
+        data = get_page(window, 0)
+    except HHApiError:
+        vacancies.partial = True
+        return vacancies
+
+    if needs_split(data, count, date_from, date_to):
+        for part_from, part_to in split_window(date_from, date_to):
+            part = fetch_window(params, count - len(vacancies), part_from, part_to)
+            vacancies.extend(part)
+            vacancies.partial = vacancies.partial or part.partial
+            if len(vacancies) >= count:
+                break
+        return vacancies
+
+    vacancies.extend(parse_items(data))
+    for page in range(1, plan_pages(data, count)):
+        try:
+            data = get_page(window, page)
+        except HHApiError:
+            vacancies.partial = True
             break
-        data = response.json()
         if not data['items']:
             break
-        for item in data['items']:
-            if vacancy_name.lower() in item['name'].lower():
-                vacancy = {
-                    'name': item['name'],
-                    'area': item['area']['name'],
-                    'salary': item.get('salary'),
-                    'experience': item['experience']['name'],
-                    'employment': item['employment']['name'],
-                    'schedule': item['schedule']['name'] if 'schedule' in item else '',
-                    'professional_roles': [role['name'] for role in item['professional_roles']],
-                    'snippet': item['snippet']['responsibility'] if item['snippet'] else '',
-                    'url': item['alternate_url'],
-                    'employer': item['employer']['name'] if 'employer' in item else 'Не указано'
-                }
-                vacancies.append(vacancy)
-                if len(vacancies) >= count:
-                    break
-        page += 1
-
-    return vacancies[:count]
+        vacancies.extend(parse_items(data))
+    return SearchResult(vacancies[:count], vacancies.partial)
+
+# Функция для парсинга вакансий, result.partial показывает, что результаты неполные.
+# Для нескольких названий или регионов до count вакансий ищется по каждому сочетанию,
+# подзапросы выполняются параллельно, не больше CONCURRENCY одновременно
+def fetch_vacancies(vacancy_name, region, count=10, salary=None, experience=None, employment=None, schedule=None):
+    queries = expand_queries(vacancy_name, region)
+    params = [build_params(name, area, salary, experience, employment, schedule) for name, area in queries]
+    if len(params) == 1:
+        results = [fetch_window(params[0], count)]
+    else:
+        with ThreadPoolExecutor(min(CONCURRENCY, len(params))) as executor:
+            results = list(executor.map(lambda p: fetch_window(p, count), params))
+    vacancies = {}
+    for found in results:
+        for v in found:
+            vacancies.setdefault(v['id'], v)
+    total = sum(len(found) for found in results)
+    vacancies_filtered.inc(total - len(vacancies), reason='duplicate')
+    return SearchResult(vacancies.values(), any(found.partial for found in results))
+
+# Асинхронный запрос одной страницы с учетом кэша
+async def fetch_page(params, page):
+    params = {**params, 'page': page}
+    if not cacheable(params):
+        return await aget_json(URL, params)
+    data = await response_cache.aget(params)
+    if data is None:
+        data = await aget_json(URL, params)
+        await response_cache.aset(params, data)
+    return data
+
+# Асинхронная выгрузка одного окна: после первой страницы известно точное
+# количество нужных страниц, они запрашиваются параллельно.
+# Ошибки страниц собираются в errors, остальные страницы продолжают загружаться.
+# semaphore ограничивает число одновременных запросов, его можно разделить между несколькими окнами
+async def fetch_window_async(params, count, errors, date_from=None, date_to=None, semaphore=None):
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+    window = window_params(params, date_from, date_to)
+    try:
+        async with semaphore:
+            data = await fetch_page(window, 0)
+    except HHApiError as e:
+        errors.append(e)
+        return
+
+    if needs_split(data, count, date_from, date_to):
+        for part_from, part_to in split_window(date_from, date_to):
+            async for batch in fetch_window_async(params, count, errors, part_from, part_to, semaphore):
+                count -= len(batch)
+                yield batch
+            if count <= 0:
+                return
+        return
+
+    pages = plan_pages(data, count)
+    batch = parse_items(data)[:count]
+    if batch:
+        count -= len(batch)
+        yield batch
+
+    async def limited(page):
+        async with semaphore:
+            return await fetch_page(window, page)
+
+    tasks = [asyncio.create_task(limited(page)) for page in range(1, pages)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            if count <= 0:
+                return
+            try:
+                data = await task
+            except HHApiError as e:
+                errors.append(e)
+                continue
+            if not data['items']:
+                continue
+            batch = parse_items(data)[:count]
+            count -= len(batch)
+            yield batch
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Асинхронный парсинг, вакансии отдаются пачками по мере получения страниц.
+# Для нескольких названий или регионов подзапросы выполняются параллельно с общим
+# ограничением CONCURRENCY, пачки отдаются в порядке получения. После завершения каждого
+# подзапроса вызывается on_progress(query, found, partial, done, total), где query - (название, регион),
+# found - сколько новых вакансий он добавил. Если часть страниц получить не удалось,
+# в конце выбрасывается PartialResultsError
+async def fetch_vacancies_async(vacancy_name, region, count=10, salary=None, experience=None, employment=None, schedule=None, on_progress=None):
+    queries = expand_queries(vacancy_name, region)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    events = asyncio.Queue()
+    errors = []
+
+    # События подзапроса передаются через общую очередь: ('batch', query, вакансии),
+    # ('done', query, признак неполных результатов) или ('error', query, исключение)
+    async def run(query):
+        params = build_params(*query, salary, experience, employment, schedule)
+        query_errors = []
+        try:
+            async for batch in fetch_window_async(params, count, query_errors, semaphore=semaphore):
+                await events.put(('batch', query, batch))
+        except Exception as e:
+            await events.put(('error', query, e))
+            return
+        errors.extend(query_errors)
+        await events.put(('done', query, bool(query_errors)))
+
+    # Подзапросы и окна по дате могут пересекаться, повторы отбрасываются
+    seen = set()
+    found = dict.fromkeys(queries, 0)
+    done = 0
+    tasks = [asyncio.create_task(run(query)) for query in queries]
+    try:
+        while done < len(queries):
+            kind, query, value = await events.get()
+            if kind == 'error':
+                raise value
+            if kind == 'done':
+                done += 1
+                if on_progress:
+                    await on_progress(query, found[query], value, done, len(queries))
+                continue
+            unique = [v for v in value if v['id'] not in seen]
+            vacancies_filtered.inc(len(value) - len(unique), reason='duplicate')
+            seen.update(v['id'] for v in unique)
+            found[query] += len(unique)
+            if unique:
+                yield unique
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if errors:
+        raise PartialResultsError(str(errors[0]))
+
+# Разбор времени публикации в формате api.hh.ru (2024-01-31T12:00:00+0300)
+def parse_published_at(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+# Вакансии, опубликованные после since. Выдача сортируется по дате публикации,
+# поэтому обычно хватает одной страницы, следующая запрашивается только если
+# вся страница оказалась новее since
+async def fetch_new_vacancies_async(since, vacancy_name, region, salary=None, experience=None, employment=None, schedule=None):
+    params = build_params(vacancy_name, region, salary, experience, employment, schedule)
+    params['order_by'] = 'publication_time'
+    params['date_from'] = since.isoformat(timespec='seconds')
+
+    for page in range(MAX_DEPTH // PER_PAGE):
+        # Кэш не используется, иначе новые вакансии появлялись бы с задержкой
+        data = await aget_json(URL, {**params, 'page': page})
+        batch = [v for v in parse_items(data) if parse_published_at(v['published_at']) > since]
+        vacancies_filtered.inc(len(data['items']) - len(batch), reason='already_seen')
+        if batch:
+            yield batch
+        if len(batch) < len(data['items']) or page + 1 >= data.get('pages', 0):
+            return
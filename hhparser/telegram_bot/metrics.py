@@ -0,0 +1,220 @@
+import os
+import time
+import asyncio
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+# Счетчик с метками
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self.values)
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in sorted(values.items())]
+
+    def summary(self):
+        with self._lock:
+            return {key: value for key, value in sorted(self.values.items())}
+
+# Гистограмма длительностей в секундах
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += counts[-1]
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+    # Оценка квантиля по границам корзин
+    def _quantile(self, counts, q):
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        return {
+            key: {
+                'count': sum(counts),
+                'avg': total / sum(counts),
+                'p50': self._quantile(counts, 0.5),
+                'p99': self._quantile(counts, 0.99),
+            }
+            for key, (counts, total) in sorted(values.items())
+        }
+
+# Заглушка для выключенных метрик
+class _NoopMetric:
+    def inc(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+_noop = _NoopMetric()
+registry = []
+
+def counter(name, help_text, labels=()):
+    if not METRICS_ENABLED:
+        return _noop
+    metric = Counter(name, help_text, labels)
+    registry.append(metric)
+    return metric
+
+def histogram(name, help_text, labels=()):
+    if not METRICS_ENABLED:
+        return _noop
+    metric = Histogram(name, help_text, labels)
+    registry.append(metric)
+    return metric
+
+# Декоратор замера длительности функции или корутины.
+# Если метрики выключены, функция возвращается без изменений
+def timed(metric, **labels):
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+# Текст в формате Prometheus
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Краткая сводка для команды /stats
+def summary_lines():
+    lines = []
+    for metric in registry:
+        for key, value in metric.summary().items():
+            name = metric.name + (f"[{', '.join(key)}]" if any(key) else '')
+            if metric.kind == 'histogram':
+                lines.append(f"{name}: {value['count']} шт., среднее {value['avg'] * 1000:.0f} мс, "
+                             f"p50 ≤ {value['p50'] * 1000:.0f} мс, p99 ≤ {value['p99'] * 1000:.0f} мс")
+            else:
+                lines.append(f'{name}: {value}')
+    return lines
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        payload = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+_server = None
+
+# HTTP-сервер метрик в фоновом потоке, доступен по /metrics
+def start_server(port=METRICS_PORT):
+    global _server
+    if not METRICS_ENABLED or _server is not None:
+        return
+    _server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+hh_request_seconds = histogram('hh_request_seconds', 'Длительность запросов к api.hh.ru', ('status',))
+db_operation_seconds = histogram('db_operation_seconds', 'Длительность операций с базой данных', ('operation',))
+handler_seconds = histogram('handler_seconds', 'Длительность обработчиков бота', ('handler',))
+hh_pages_fetched = counter('hh_pages_fetched_total', 'Страниц, полученных от api.hh.ru')
+vacancies_filtered = counter('vacancies_filtered_total', 'Вакансий, отброшенных после загрузки', ('reason',))
+rows_inserted = counter('rows_inserted_total', 'Строк, записанных в таблицу vacancies', ('kind',))
+vacancy_details = counter('vacancy_details_total', 'Проверенные подробности вакансий', ('result',))
+messages_sent = counter('messages_sent_total', 'Сообщений, отправленных в Telegram')
@@ -0,0 +1,137 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+from telegram.ext import BasePersistence, PersistenceInput
+from database import run_db, load_bot_state, save_bot_state
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 1))  # Как часто записывать состояние, секунды
+
+_NEVER = datetime.min.replace(tzinfo=timezone.utc)
+
+# Хранение user_data и состояний диалогов в Postgres.
+# Состояние пользователя читается из базы перед обработкой его обновления (см. refresh),
+# изменения накапливаются и записываются одной транзакцией раз в update_interval.
+# shared - состояние могут менять другие процессы бота, поэтому оно перечитывается при каждом обновлении
+class PostgresPersistence(BasePersistence):
+    def __init__(self, shared=False, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.shared = shared
+        self._users = {}
+        self._conversations = {}
+        # Время последней записи, которую видел этот процесс, по ключу строки
+        self._versions = {}
+        self._write_task = None
+
+    # Данные загружаются по мере обращения пользователей, а не целиком при запуске
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        self._users[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._users[user_id] = {}
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, json.dumps(key))] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # Все изменения, переданные за один проход update_persistence, попадают в одну запись
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        await asyncio.sleep(0)
+        while self._users or self._conversations:
+            users, self._users = self._users, {}
+            conversations, self._conversations = self._conversations, {}
+            try:
+                self._versions.update(await run_db(save_bot_state, users, conversations))
+            except Exception:
+                logger.exception('Ошибка записи состояния бота, повтор при следующем обновлении')
+                # Более новые изменения, пришедшие во время записи, не перезаписываются
+                for user_id, data in users.items():
+                    self._users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._conversations.setdefault(key, state)
+                return
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
+
+    # Чтение состояния пользователя перед обработкой обновления. Данные из базы заменяют данные
+    # в памяти, только если их записал другой процесс позже, чем этот процесс видел в последний раз.
+    # handler - ConversationHandler с per_chat и per_user, его ключ диалога - (chat_id, user_id)
+    async def refresh(self, update, context, handler):
+        user, chat = update.effective_user, update.effective_chat
+        if user is None or chat is None:
+            return
+        user_version = ('user', user.id)
+        if not self.shared and user_version in self._versions:
+            return
+
+        key = (chat.id, user.id)
+        conversation_version = (handler.name, json.dumps(key))
+        data, data_updated, state, state_updated = await run_db(load_bot_state, user.id, handler.name, conversation_version[1])
+        self._versions.setdefault(user_version, _NEVER)
+
+        if data_updated and data_updated > self._versions[user_version] and user.id not in self._users:
+            context.user_data.clear()
+            context.user_data.update(data)
+            self._versions[user_version] = data_updated
+        if state_updated and state_updated > self._versions.get(conversation_version, _NEVER) and conversation_version not in self._conversations:
+            # У ConversationHandler нет открытого способа заменить состояние одного диалога, поэтому
+            # используется внутренний TrackingDict PTB (_conversations, update_no_track). Он проверен
+            # на python-telegram-bot 20.0, версия закреплена в requirements.txt и при обновлении PTB
+            # этот код нужно проверить заново
+            conversations = handler._conversations
+            if state is None:
+                conversations.data.pop(key, None)
+            else:
+                conversations.update_no_track({key: state})
+            self._versions[conversation_version] = state_updated
@@ -0,0 +1,40 @@
+import time
+import asyncio
+import threading
+
+# Ограничитель частоты по алгоритму token bucket:
+# rate токенов в секунду, не больше capacity накопленных токенов.
+# Работает и из цикла событий, и из обычных потоков
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Попытка взять токен, возвращает время ожидания до следующего токена
+    def _take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # Ожидание свободного токена
+    async def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
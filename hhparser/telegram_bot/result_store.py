@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict
+from database import run_db, insert_pending_results, take_pending_results, delete_pending_results, purge_pending_results
+
+logger = logging.getLogger(__name__)
+
+RESULTS_USER_LIMIT = int(os.getenv('RESULTS_USER_LIMIT', 1024 * 1024))  # Байт на одного пользователя
+RESULTS_TOTAL_LIMIT = int(os.getenv('RESULTS_TOTAL_LIMIT', 200 * 1024 * 1024))  # Байт на всех пользователей
+RESULTS_TTL = int(os.getenv('RESULTS_TTL', 6 * 3600))  # Сколько секунд хранить несохраненные результаты
+
+SALARY_FIELDS = ('from', 'to', 'currency', 'gross')
+
+# Компактная запись вакансии: без словаря атрибутов, повторяющиеся строки интернированы
+class VacancyRecord:
+    __slots__ = ('id', 'published_at', 'name', 'area', 'salary', 'experience', 'employment',
+                 'schedule', 'professional_roles', 'snippet', 'url', 'employer')
+
+    @classmethod
+    def from_dict(cls, v):
+        record = cls()
+        record.id = v.get('id')
+        record.published_at = v.get('published_at')
+        record.name = v['name']
+        record.area = sys.intern(v['area'])
+        salary = v['salary']
+        if salary:
+            currency = salary.get('currency')
+            record.salary = (salary.get('from'), salary.get('to'), currency and sys.intern(currency), salary.get('gross'))
+        else:
+            record.salary = None
+        record.experience = sys.intern(v['experience'])
+        record.employment = sys.intern(v['employment'])
+        record.schedule = sys.intern(v['schedule'])
+        record.professional_roles = tuple(sys.intern(role) for role in v['professional_roles'])
+        record.snippet = v['snippet']
+        record.url = v['url']
+        record.employer = sys.intern(v['employer'])
+        return record
+
+    def to_dict(self):
+        v = {name: getattr(self, name) for name in self.__slots__}
+        v['salary'] = dict(zip(SALARY_FIELDS, self.salary)) if self.salary else None
+        v['professional_roles'] = list(self.professional_roles)
+        return v
+
+    # Приблизительный размер в байтах, интернированные строки не учитываются
+    def size(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.professional_roles)
+        for value in (self.id, self.published_at, self.name, self.snippet, self.url, self.salary):
+            if value is not None:
+                size += sys.getsizeof(value)
+        return size
+
+class _Entry:
+    __slots__ = ('records', 'size', 'touched', 'spilled')
+
+    def __init__(self):
+        self.records = []
+        self.size = 0
+        self.touched = time.monotonic()
+        self.spilled = False
+
+# Хранилище результатов поиска до команды /save.
+# Пользователи вытесняются по LRU при превышении общего лимита и по TTL,
+# результаты больше лимита пользователя и вытесненные по LRU переносятся в Postgres.
+# shared - бот запущен в нескольких процессах, и все результаты сразу хранятся в Postgres
+class ResultStore:
+    def __init__(self, user_limit=RESULTS_USER_LIMIT, total_limit=RESULTS_TOTAL_LIMIT, ttl=RESULTS_TTL, shared=False):
+        self.user_limit = user_limit
+        self.total_limit = total_limit
+        self.ttl = ttl
+        self.shared = shared
+        self.total_size = 0
+        self._entries = OrderedDict()
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.total_size -= entry.size
+        return entry
+
+    async def _spill(self, user_id, entry):
+        self.total_size -= entry.size
+        vacancies = [r.to_dict() for r in entry.records]
+        entry.records = []
+        entry.size = 0
+        entry.spilled = True
+        if vacancies:
+            await run_db(insert_pending_results, user_id, vacancies)
+
+    # Удаление просроченных записей и вытеснение давно не использованных при нехватке памяти
+    async def _evict(self):
+        now = time.monotonic()
+        # Записи упорядочены по времени последнего обращения
+        for user_id, entry in list(self._entries.items()):
+            if now - entry.touched > self.ttl:
+                self._remove(user_id)
+                if entry.spilled:
+                    await run_db(delete_pending_results, user_id)
+            elif self.total_size > self.total_limit:
+                if not entry.spilled:
+                    logger.info('Результаты пользователя %s перенесены в базу данных из-за общего лимита памяти', user_id)
+                    await self._spill(user_id, entry)
+            else:
+                break
+
+    # Новый поиск пользователя заменяет предыдущие несохраненные результаты
+    async def reset(self, user_id):
+        entry = self._remove(user_id)
+        if self.shared or (entry is not None and entry.spilled):
+            await run_db(delete_pending_results, user_id)
+
+    async def append(self, user_id, vacancies):
+        if self.shared:
+            await run_db(insert_pending_results, user_id, vacancies)
+            return
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = _Entry()
+        self._entries.move_to_end(user_id)
+        entry.touched = time.monotonic()
+
+        if entry.spilled:
+            await run_db(insert_pending_results, user_id, vacancies)
+            return
+        added = 0
+        for v in vacancies:
+            record = VacancyRecord.from_dict(v)
+            entry.records.append(record)
+            added += record.size()
+        entry.size += added
+        self.total_size += added
+        if entry.size > self.user_limit:
+            logger.info('Результаты пользователя %s перенесены в базу данных из-за лимита пользователя', user_id)
+            await self._spill(user_id, entry)
+        await self._evict()
+
+    # Извлечение результатов пользователя для сохранения
+    async def pop(self, user_id):
+        if self.shared:
+            return await run_db(take_pending_results, user_id)
+        entry = self._remove(user_id)
+        if entry is None:
+            return []
+        if entry.spilled:
+            return await run_db(take_pending_results, user_id)
+        return [r.to_dict() for r in entry.records]
+
+    async def purge_expired(self):
+        await self._evict()
+        return await run_db(purge_pending_results, self.ttl)
+
+    # Объем памяти, занятый результатами пользователя, в байтах
+    def memory_usage(self, user_id):
+        entry = self._entries.get(user_id)
+        return entry.size if entry else 0
+
+    # Пользователи, занимающие больше всего памяти
+    def usage_by_user(self, limit=10):
+        usage = [(user_id, entry.size) for user_id, entry in self._entries.items()]
+        return sorted(usage, key=lambda item: item[1], reverse=True)[:limit]
+
+    def stats(self):
+        return {
+            'users': len(self._entries),
+            'spilled_users': sum(1 for e in self._entries.values() if e.spilled),
+            'bytes': self.total_size,
+            'limit': self.total_limit,
+        }
+
+result_store = ResultStore()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError
+from ratelimit import TokenBucket
+from metrics import messages_sent
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения в Telegram
+GLOBAL_RATE = 25  # Сообщений в секунду на всего бота
+CHAT_RATE = 1  # Сообщений в секунду в один чат
+CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без ожидания
+MAX_CHATS = 10000  # Сколько ограничителей чатов хранить одновременно
+MAX_RETRIES = 5
+BACKOFF = 1  # Начальная задержка повтора при сетевой ошибке, секунды
+
+# Форматирование зарплаты в читаемый вид
+def format_salary(salary):
+    if salary is None:
+        return "Не указана"
+    elif isinstance(salary, dict):
+        if salary['from'] and salary['to']:
+            return f"{salary['from']} - {salary['to']} {salary['currency']}"
+        elif salary['from']:
+            return f"от {salary['from']} {salary['currency']}"
+        elif salary['to']:
+            return f"до {salary['to']} {salary['currency']}"
+    return "Не указана"
+
+# Текст сообщения об одной вакансии
+def format_vacancy(v):
+    message = (
+        f"Название: {v['name']}\n"
+        f"Регион: {v['area']}\n"
+        f"Зарплата: {format_salary(v['salary'])}\n"
+        f"Опыт: {v['experience']}\n"
+        f"Тип занятости: {v['employment']}\n"
+        f"График работы: {v['schedule']}\n"
+        f"Роли: {', '.join(v['professional_roles'] or [])}\n"
+        f"Описание: {v['snippet']}\n"
+        f"Компания: {v['employer']}\n"
+        f"Ссылка: {v['url']}\n"
+        "------------------------------"
+    )
+    return message.strip()
+
+# Упаковка нескольких текстов в сообщения не длиннее limit символов
+def pack_messages(texts, limit=MESSAGE_LIMIT):
+    messages = []
+    current = ''
+    for text in texts:
+        if len(text) > limit:
+            text = text[:limit - 1] + '…'
+        if current and len(current) + 1 + len(text) > limit:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{text}' if current else text
+    if current:
+        messages.append(current)
+    return messages
+
+# Отправка сообщений с учетом ограничений Telegram на частоту
+class MessageSender:
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = OrderedDict()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > MAX_CHATS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    # Отправка одного сообщения, при RetryAfter ждем указанное Telegram время
+    async def send(self, bot, chat_id, text):
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(MAX_RETRIES):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                message = await bot.send_message(chat_id=chat_id, text=text)
+                messages_sent.inc()
+                return message
+            except RetryAfter as e:
+                logger.warning('Превышен лимит Telegram для чата %s, ожидание %s с', chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (BadRequest, Forbidden):
+                raise
+            except NetworkError as e:
+                delay = BACKOFF * 2 ** attempt
+                logger.warning('Ошибка отправки в чат %s: %s, повтор через %s с', chat_id, e, delay)
+                await asyncio.sleep(delay)
+        logger.error('Не удалось отправить сообщение в чат %s после %s попыток', chat_id, MAX_RETRIES)
+
+    # Отправка текстов, упакованных в минимальное количество сообщений
+    async def send_texts(self, bot, chat_id, texts):
+        for message in pack_messages(texts):
+            await self.send(bot, chat_id, message)
+
+    async def send_vacancies(self, bot, chat_id, vacancies):
+        await self.send_texts(bot, chat_id, [format_vacancy(v) for v in vacancies])
+
+sender = MessageSender()
@@ -0,0 +1,54 @@
+import os
+import asyncio
+import logging
+from telegram.ext import CallbackContext
+from hh_parser import fetch_new_vacancies_async, parse_published_at
+from database import run_db, all_subscriptions, update_high_water
+from write_queue import write_queue
+from sender import sender
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_INTERVAL = int(os.getenv('SUBSCRIPTION_INTERVAL', 1800))  # Период обновления, секунды
+SUBSCRIPTION_CONCURRENCY = 5  # Сколько сохраненных поисков обновлять одновременно
+
+# Описание сохраненного поиска для пользователя
+def describe_query(query):
+    parts = [f"«{query['vacancy_name']}», регион {query['region']}"]
+    if query.get('salary'):
+        parts.append(f"зарплата {query['salary'][0]}-{query['salary'][1]}")
+    for key in ('experience', 'employment', 'schedule'):
+        if query.get(key):
+            parts.append(query[key])
+    return ', '.join(parts)
+
+# Обновление одного сохраненного поиска: только вакансии новее high_water
+async def refresh_subscription(bot, subscription_id, chat_id, query, high_water):
+    vacancies = []
+    async for batch in fetch_new_vacancies_async(high_water, **query):
+        vacancies.extend(batch)
+    if not vacancies:
+        return 0
+
+    await write_queue.put(chat_id, vacancies)
+    await sender.send(bot, chat_id, f'Новые вакансии по поиску {describe_query(query)}:')
+    await sender.send_vacancies(bot, chat_id, vacancies)
+    newest = max(parse_published_at(v['published_at']) for v in vacancies)
+    await run_db(update_high_water, subscription_id, newest)
+    return len(vacancies)
+
+# Задача JobQueue: обновление всех сохраненных поисков
+async def refresh_subscriptions(context: CallbackContext) -> None:
+    semaphore = asyncio.Semaphore(SUBSCRIPTION_CONCURRENCY)
+
+    async def limited(subscription):
+        async with semaphore:
+            try:
+                return await refresh_subscription(context.bot, *subscription)
+            except Exception:
+                logger.exception('Ошибка обновления сохраненного поиска %s', subscription[0])
+                return 0
+
+    subscriptions = await run_db(all_subscriptions)
+    found = await asyncio.gather(*(limited(s) for s in subscriptions))
+    logger.info('Обновлено сохраненных поисков: %s, новых вакансий: %s', len(subscriptions), sum(found))
@@ -1,11 +1,34 @@
 import os
+import re
+import glob
+import signal
+import asyncio
 import logging
+import multiprocessing
+import io
 import csv
+import gzip
+import tempfile
+import httpx
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ConversationHandler, CallbackQueryHandler
-from hh_parser import fetch_vacancies
-from database import create_table, insert_vacancies, fetch_all_vacancies, clear_table
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, filters, CallbackContext, ConversationHandler, CallbackQueryHandler
+from hh_parser import fetch_vacancies_async, expand_queries, close_client, HHApiError
+from sender import GLOBAL_RATE, CHAT_RATE, CHAT_BURST, sender, format_salary, pack_messages
+from result_store import result_store
+from write_queue import WRITE_SPOOL_PATH, write_queue
+from persistence import PostgresPersistence
+from details import HH_DETAILS, enrich_vacancies
+from columnar import write_columnar, compress_zstd
+from analytics import salary_analytics, salary_report
+from cache import response_cache
+import hh_client
+from hh_client import breaker
+from ratelimit import TokenBucket
+import metrics
+from metrics import timed, handler_seconds
+from subscriptions import SUBSCRIPTION_INTERVAL, describe_query, refresh_subscriptions
+from database import VACANCY_COLUMNS, FIND_PAGE_SIZE, init_db, close_pool, run_db, has_vacancies, iter_vacancies, aiter_vacancies, find_vacancies, add_subscription, list_subscriptions, delete_subscription, clear_vacancies, claim_legacy_vacancies
 
 # Загрузка перменных окружения из .env файла
 load_dotenv()
@@ -17,25 +40,22 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Форматирование зарплаты в читаемый вид
-def format_salary(salary):
-    if salary is None:
-        return "Не указана"
-    elif isinstance(salary, dict):
-        if salary['from'] and salary['to']:
-            return f"{salary['from']} - {salary['to']} {salary['currency']}"
-        elif salary['from']:
-            return f"от {salary['from']} {salary['currency']}"
-        elif salary['to']:
-            return f"до {salary['to']} {salary['currency']}"
-    return "Не указана"
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024  # Файл экспорта больше этого размера уходит из памяти на диск
+SALARY_DIMENSION_NAMES = {'роль': 'role', 'регион': 'area', 'опыт': 'experience', 'работодатель': 'employer'}
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling или webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес балансировщика, на который Telegram присылает обновления
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))  # Порт первого процесса, следующие слушают WEBHOOK_PORT + 1, ...
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
 
 # Состояния
 SEARCH, REGION, COUNT, FILTERS, SALARY, EXPERIENCE, EMPLOYMENT, SCHEDULE = range(8)
 
 # Команда старт
 async def start(update: Update, context: CallbackContext) -> None:
-    keyboard = [['/start', '/search', '/save', '/export', '/clear']]
+    keyboard = [['/start', '/search', '/save', '/export', '/find', '/salary', '/subscribe', '/clear']]
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
     await update.message.reply_text(
         'Привет! Этот бот умеет парсить вакансии с hh.ru.\nВыберите команду:',
@@ -44,13 +64,13 @@ async def start(update: Update, context: CallbackContext) -> None:
 
 # Команда поиска
 async def search_start(update: Update, context: CallbackContext) -> int:
-    await update.message.reply_text('Введите название вакансии, которую вы хотите найти:')
+    await update.message.reply_text('Введите название вакансии, которую вы хотите найти (несколько названий - через «;»):')
     return SEARCH
 
 # Запрос региона
 async def search_vacancy(update: Update, context: CallbackContext) -> int:
     context.user_data['vacancy'] = update.message.text
-    await update.message.reply_text('Введите регион для поиска вакансий:')
+    await update.message.reply_text('Введите регион для поиска вакансий (несколько регионов - через запятую):')
     return REGION
 
 # Запрос количества вакансий
@@ -196,63 +216,77 @@ async def schedule_input(update: Update, context: CallbackContext) -> int:
     context.user_data['schedule'] = schedule_map.get(query.data, 'Полный день')
     return await filter_menu(update, context)
 
+# Названия вакансий разделяются «;», регионы - запятыми или «;»
+def split_search_lists(vacancy, region):
+    titles = [title.strip() for title in vacancy.split(';') if title.strip()] or [vacancy]
+    regions = [area.strip() for area in re.split(r'[,;]', region) if area.strip()] or [region]
+    return titles, regions
+
 # Функция для управления поиском
 async def perform_search(update: Update, context: CallbackContext) -> int:
-    vacancy = context.user_data.get('vacancy')
-    region = context.user_data.get('region')
+    vacancy, region = split_search_lists(context.user_data.get('vacancy'), context.user_data.get('region'))
     count = context.user_data.get('count')
     salary = context.user_data.get('salary')
     experience = context.user_data.get('experience')
     employment = context.user_data.get('employment')
     schedule = context.user_data.get('schedule')
 
-    vacancies = fetch_vacancies(vacancy, region, count, salary, experience, employment, schedule)
-    context.user_data['vacancies'] = vacancies
+    chat_id = update.effective_chat.id
 
-    if vacancies:
-        for v in vacancies:
-            formatted_salary = format_salary(v['salary'])
-            message = (
-                f"Название: {v['name']}\n"
-                f"Регион: {v['area']}\n"
-                f"Зарплата: {formatted_salary}\n"
-                f"Опыт: {v['experience']}\n"
-                f"Тип занятости: {v['employment']}\n"
-                f"График работы: {v['schedule']}\n"
-                f"Роли: {', '.join(v['professional_roles'])}\n"
-                f"Описание: {v['snippet']}\n"
-                f"Компания: {v['employer']}\n"
-                f"Ссылка: {v['url']}\n"
-                "------------------------------"
-            )
-            if update.callback_query:
-                await update.callback_query.message.reply_text(message.strip())
-            else:
-                await update.message.reply_text(message.strip())
-    else:
-        if update.callback_query:
-            await update.callback_query.message.reply_text('Вакансии не найдены.')
+    user_id = update.effective_user.id
+
+    # Если названий или регионов несколько, после каждого подзапроса сообщается, сколько он нашел
+    async def report_progress(query, query_found, partial, done, total):
+        if total > 1:
+            note = ', hh.ru ответил не на все запросы' if partial else ''
+            await sender.send(context.bot, chat_id, f'«{query[0]}», регион {query[1]}: новых вакансий {query_found}{note} ({done} из {total}).')
+
+    # Вакансии отправляются по мере загрузки страниц, не дожидаясь последней,
+    # и хранятся в result_store до команды /save
+    found = 0
+    await result_store.reset(user_id)
+    try:
+        async for batch in fetch_vacancies_async(vacancy, region, count, salary, experience, employment, schedule, report_progress):
+            found += len(batch)
+            await result_store.append(user_id, batch)
+            await sender.send_vacancies(context.bot, chat_id, batch)
+    except HHApiError as e:
+        logger.warning('Поиск выполнен не полностью: %s', e)
+        if found:
+            await sender.send(context.bot, chat_id, 'hh.ru ответил не на все запросы, показаны не все найденные вакансии.')
         else:
-            await update.message.reply_text('Вакансии не найдены.')
+            await sender.send(context.bot, chat_id, 'hh.ru временно недоступен, попробуйте позже.')
+        return ConversationHandler.END
+
+    if not found:
+        await sender.send(context.bot, chat_id, 'Вакансии не найдены.')
 
     return ConversationHandler.END
 
 # Команда сохранения
 async def save(update: Update, context: CallbackContext) -> None:
-    create_table()
-    vacancies = context.user_data.get('vacancies', [])
+    vacancies = await result_store.pop(update.effective_user.id)
     if vacancies:
-        insert_vacancies(vacancies)
+        # Запись в базу выполняется в фоне общими пачками, вакансии принадлежат текущему чату
+        await write_queue.put(update.effective_chat.id, vacancies)
+        if HH_DETAILS:
+            context.application.create_task(enrich_saved(vacancies))
         await update.message.reply_text('Вакансии сохранены в базе данных.')
-        context.user_data.pop('vacancies', None)
         return ConversationHandler.END
     else:
         await update.message.reply_text('Нет вакансий для сохранения.')
 
-# Команда экспорта
+# Фоновая загрузка подробностей сохраненных вакансий
+async def enrich_saved(vacancies):
+    counts = await enrich_vacancies(vacancies)
+    logger.info('Подробности вакансий: %s', counts)
+
+# Команда экспорта, после команды можно указать фильтр в формате /find
 async def export_start(update: Update, context: CallbackContext) -> None:
-    vacancies = fetch_all_vacancies()
-    if not vacancies:
+    if update.message:
+        context.user_data['export_filters'] = parse_find_query(' '.join(context.args)) if context.args else {}
+    await write_queue.flush_chat(update.effective_chat.id)
+    if not await run_db(has_vacancies, update.effective_chat.id):
         if update.message:
             await update.message.reply_text('Нет данных для экспорта.')
         else:
@@ -261,6 +295,10 @@ async def export_start(update: Update, context: CallbackContext) -> None:
 
     keyboard = [
         [InlineKeyboardButton("Экспорт в CSV", callback_data='export_csv')],
+        [InlineKeyboardButton("Экспорт в CSV (gzip)", callback_data='export_csv_gz')],
+        [InlineKeyboardButton("Экспорт в CSV (zstd)", callback_data='export_csv_zst')],
+        [InlineKeyboardButton("Экспорт в Parquet", callback_data='export_parquet')],
+        [InlineKeyboardButton("Экспорт в Arrow", callback_data='export_arrow')],
         [InlineKeyboardButton("Экспорт в чат", callback_data='export_chat')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -274,89 +312,434 @@ async def export_start(update: Update, context: CallbackContext) -> None:
 async def export_handler(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
+    await write_queue.flush_chat(update.effective_chat.id)
     
     if query.data == 'export_csv':
         await export_to_csv(update, context)
+    elif query.data == 'export_csv_gz':
+        await export_to_csv(update, context, compression='gzip')
+    elif query.data == 'export_csv_zst':
+        await export_to_csv(update, context, compression='zstd')
+    elif query.data == 'export_parquet':
+        await export_to_columnar(update, context, 'parquet')
+    elif query.data == 'export_arrow':
+        await export_to_columnar(update, context, 'arrow')
     elif query.data == 'export_chat':
         await export_to_chat(update, context)
 
+# Построение CSV с вакансиями чата в отдельном буфере для каждого запроса, строки читаются из базы пачками.
+# compression - None, 'gzip' или 'zstd'
+def build_csv(chat_id, compression=None, filters=None):
+    buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    output = gzip.GzipFile(fileobj=buffer, mode='wb') if compression == 'gzip' else buffer
+    encode = (lambda text: compress_zstd(text.encode('utf-8'))) if compression == 'zstd' else (lambda text: text.encode('utf-8'))
+
+    chunk = io.StringIO()
+    writer = csv.writer(chunk)
+    writer.writerow(['Название', 'Регион', 'Зарплата', 'Опыт', 'Тип занятости', 'График работы', 'Роли', 'Описание', 'Компания', 'Ссылка'])
+    for rows in iter_vacancies(chat_id, **(filters or {})):
+        for v in rows:
+            name, area, salary, experience, employment, schedule, roles, snippet, employer, url = v
+            formatted_salary = format_salary(salary)
+            writer.writerow([name, area, formatted_salary, experience, employment, schedule, ', '.join(roles), snippet, employer, url])
+        output.write(encode(chunk.getvalue()))
+        chunk.seek(0)
+        chunk.truncate()
+    if chunk.tell():
+        output.write(encode(chunk.getvalue()))
+
+    if compression == 'gzip':
+        output.close()
+    buffer.seek(0)
+    return buffer
+
 # Функция для экспорта в CSV
-async def export_to_csv(update: Update, context: CallbackContext):
-    vacancies = fetch_all_vacancies()
-    if not vacancies:
+async def export_to_csv(update: Update, context: CallbackContext, compression=None):
+    if not await run_db(has_vacancies, update.effective_chat.id):
         await update.callback_query.answer('Нет данных для экспорта.', show_alert=True)
         return
 
-    file_path = '/tmp/vacancies.csv'
-    with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Название', 'Регион', 'Зарплата', 'Опыт', 'Тип занятости', 'График работы', 'Роли', 'Описание', 'Компания', 'Ссылка'])
-
-        for v in vacancies:
-            name, area, salary, experience, employment, schedule, roles, snippet, employer, url = v
-            formatted_salary = format_salary(salary)
-            writer.writerow([name, area, formatted_salary, experience, employment, schedule, ', '.join(roles), snippet, employer, url])
+    buffer = await run_db(build_csv, update.effective_chat.id, compression, context.user_data.get('export_filters'))
+    filename = {None: 'vacancies.csv', 'gzip': 'vacancies.csv.gz', 'zstd': 'vacancies.csv.zst'}[compression]
+    try:
+        await update.callback_query.message.reply_document(buffer, filename=filename)
+    finally:
+        buffer.close()
 
-    with open(file_path, 'rb') as file:
-        await update.callback_query.message.reply_document(file)
+# Построение файла Parquet или Arrow IPC с вакансиями чата
+def build_columnar(chat_id, format, filters=None):
+    buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        write_columnar(buffer, format, chat_id, filters)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+# Функция для экспорта в Parquet или Arrow с типизированной зарплатой и списком ролей
+async def export_to_columnar(update: Update, context: CallbackContext, format):
+    if not await run_db(has_vacancies, update.effective_chat.id):
+        await update.callback_query.answer('Нет данных для экспорта.', show_alert=True)
+        return
 
-    os.remove(file_path)
+    buffer = await run_db(build_columnar, update.effective_chat.id, format, context.user_data.get('export_filters'))
+    filename = 'vacancies.parquet' if format == 'parquet' else 'vacancies.arrow'
+    try:
+        await update.callback_query.message.reply_document(buffer, filename=filename)
+    finally:
+        buffer.close()
 
 # Функция для экспорта в чат
 async def export_to_chat(update: Update, context: CallbackContext):
-    vacancies = fetch_all_vacancies()
-    if not vacancies:
+    if not await run_db(has_vacancies, update.effective_chat.id):
         await update.callback_query.answer('Нет данных для экспорта.', show_alert=True)
         return
 
-    for v in vacancies:
-        name, area, salary, experience, employment, schedule, roles, snippet, employer, url = v
-        formatted_salary = format_salary(salary)
-        message = (
-            f"Название: {name}\n"
-            f"Регион: {area}\n"
-            f"Зарплата: {formatted_salary}\n"
-            f"Опыт: {experience}\n"
-            f"Тип занятости: {employment}\n"
-            f"График работы: {schedule}\n"
-            f"Роли: {', '.join(roles)}\n"
-            f"Описание: {snippet}\n"
-            f"Компания: {employer}\n"
-            f"Ссылка: {url}\n"
-            "------------------------------"
+    chat_id = update.effective_chat.id
+    async for rows in aiter_vacancies(chat_id, **context.user_data.get('export_filters', {})):
+        await sender.send_vacancies(context.bot, chat_id, [dict(zip(VACANCY_COLUMNS, row)) for row in rows])
+
+# Разбор запроса /find: слова для поиска, зп:от-до и роль:название (до конца строки)
+def parse_find_query(text):
+    query = {'text': None, 'salary_min': None, 'salary_max': None, 'role': None}
+    if 'роль:' in text:
+        text, role = text.split('роль:', 1)
+        query['role'] = role.strip() or None
+    words = []
+    for word in text.split():
+        if word.startswith('зп:'):
+            salary_from, _, salary_to = word[3:].partition('-')
+            if salary_from.isdigit():
+                query['salary_min'] = int(salary_from)
+            if salary_to.isdigit():
+                query['salary_max'] = int(salary_to)
+        else:
+            words.append(word)
+    query['text'] = ' '.join(words) or None
+    return query
+
+# Отправка страницы результатов поиска по сохраненным вакансиям
+async def send_find_page(update: Update, context: CallbackContext, after_id=0) -> None:
+    chat_id = update.effective_chat.id
+    rows = await run_db(find_vacancies, chat_id, after_id=after_id, **context.user_data['find'])
+    if not rows:
+        await sender.send(context.bot, chat_id, 'Вакансии не найдены.' if after_id == 0 else 'Больше вакансий нет.')
+        return
+
+    await sender.send_vacancies(context.bot, chat_id, [dict(zip(VACANCY_COLUMNS, row[1:])) for row in rows])
+    if len(rows) == FIND_PAGE_SIZE:
+        context.user_data['find_after'] = rows[-1][0]
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Показать еще", callback_data='find_next')]])
+        await context.bot.send_message(chat_id=chat_id, text='Есть еще вакансии.', reply_markup=reply_markup)
+
+# Команда поиска по сохраненным вакансиям
+async def find(update: Update, context: CallbackContext) -> None:
+    if not context.args:
+        await update.message.reply_text(
+            'Использование: /find слова зп:от-до роль:название\n'
+            'Например: /find python зп:100000-200000 роль:Программист, разработчик'
         )
-        await update.callback_query.message.reply_text(message.strip())
+        return
+    context.user_data['find'] = parse_find_query(' '.join(context.args))
+    await write_queue.flush_chat(update.effective_chat.id)
+    await send_find_page(update, context)
+
+# Следующая страница результатов /find
+async def find_next(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    if 'find' not in context.user_data:
+        await query.message.reply_text('Повторите поиск командой /find.')
+        return
+    await send_find_page(update, context, context.user_data.get('find_after', 0))
+
+# Команда подписки на последний поиск
+async def subscribe(update: Update, context: CallbackContext) -> None:
+    if not context.user_data.get('vacancy'):
+        await update.message.reply_text('Сначала выполните поиск командой /search.')
+        return
+
+    # Поиск по нескольким названиям или регионам сохраняется отдельным поиском для каждого сочетания
+    titles, regions = split_search_lists(context.user_data['vacancy'], context.user_data['region'])
+    lines = []
+    for vacancy_name, region in expand_queries(titles, regions):
+        query = {
+            'vacancy_name': vacancy_name,
+            'region': region,
+            'salary': context.user_data.get('salary'),
+            'experience': context.user_data.get('experience'),
+            'employment': context.user_data.get('employment'),
+            'schedule': context.user_data.get('schedule'),
+        }
+        subscription_id = await run_db(add_subscription, update.effective_chat.id, query)
+        lines.append(f'Поиск {describe_query(query)} сохранен под номером {subscription_id}.')
+    lines.append('Новые вакансии будут приходить автоматически.')
+    await update.message.reply_text('\n'.join(lines))
+
+# Список сохраненных поисков
+async def subscriptions_list(update: Update, context: CallbackContext) -> None:
+    subscriptions = await run_db(list_subscriptions, update.effective_chat.id)
+    if not subscriptions:
+        await update.message.reply_text('Нет сохраненных поисков.')
+        return
+    lines = [f'{subscription_id}. {describe_query(query)}' for subscription_id, query, _ in subscriptions]
+    lines.append('Удалить поиск: /unsubscribe номер')
+    await update.message.reply_text('\n'.join(lines))
+
+# Удаление сохраненного поиска
+async def unsubscribe(update: Update, context: CallbackContext) -> None:
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text('Использование: /unsubscribe номер')
+        return
+    if await run_db(delete_subscription, update.effective_chat.id, int(context.args[0])):
+        await update.message.reply_text('Сохраненный поиск удален.')
+    else:
+        await update.message.reply_text('Сохраненный поиск не найден.')
 
-# Команда очистки
+# Команда очистки, удаляются только вакансии текущего чата
 async def clear(update: Update, context: CallbackContext) -> None:
-    clear_table()
-    await update.message.reply_text('Все сохраненные вакансии были удалены.')
+    chat_id = update.effective_chat.id
+    # Вакансии чата убираются из очереди до очистки, иначе они появились бы после нее
+    await write_queue.discard(chat_id)
+    await run_db(clear_vacancies, chat_id)
+    salary_analytics.invalidate(chat_id)
+    await update.message.reply_text('Все сохраненные вакансии этого чата были удалены.')
+
+# Зарплатная аналитика по сохраненным вакансиям
+async def salary(update: Update, context: CallbackContext) -> None:
+    dimension_name = context.args[0].lower() if context.args else 'роль'
+    if dimension_name not in SALARY_DIMENSION_NAMES:
+        await update.message.reply_text(
+            'Использование: /salary [роль|регион|опыт|работодатель] [значение]\n'
+            'Например: /salary регион или /salary регион Москва'
+        )
+        return
+    value = ' '.join(context.args[1:]) or None
 
-def main() -> None:
-    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+    # Расчет по сохраненным вакансиям чата выполняется вне цикла событий
+    lines = await asyncio.to_thread(salary_report, update.effective_chat.id, SALARY_DIMENSION_NAMES[dimension_name], value)
+    if not lines:
+        await update.message.reply_text('Нет сохраненных вакансий с указанной зарплатой.')
+        return
+    await sender.send_texts(context.bot, update.effective_chat.id, ['Зарплаты в рублях:'] + lines)
+
+# Команда статистики для администраторов
+async def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text('Команда доступна только администраторам.')
+        return
+
+    cache_stats = response_cache.stats()
+    store_stats = result_store.stats()
+    lines = [
+        f"Кэш hh.ru: попаданий {cache_stats['hits']} (из базы {cache_stats['db_hits']}), промахов {cache_stats['misses']}, записей {cache_stats['size']}",
+        f"Circuit breaker api.hh.ru: {breaker.state}",
+        f"Очередь записи в базу: {len(write_queue)} вакансий",
+        f"Несохраненные результаты: {store_stats['users']} польз., {store_stats['bytes'] // 1024} КБ из {store_stats['limit'] // 1024} КБ, в базе {store_stats['spilled_users']} польз.",
+    ]
+    lines.extend(f'  {user_id}: {size // 1024} КБ' for user_id, size in result_store.usage_by_user(5))
+    if metrics.METRICS_ENABLED:
+        lines.extend(metrics.summary_lines())
+    else:
+        lines.append('Метрики выключены (METRICS_ENABLED=1 для включения).')
+    for message in pack_messages(lines):
+        await update.message.reply_text(message)
+
+# Перенос вакансий, сохраненных до разделения по чатам, в чат администратора
+async def claim(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text('Команда доступна только администраторам.')
+        return
+
+    chat_id = update.effective_chat.id
+    claimed = await run_db(claim_legacy_vacancies, chat_id)
+    salary_analytics.invalidate(chat_id)
+    await update.message.reply_text(f'В этот чат перенесено вакансий без владельца: {claimed}.')
+
+# Замер длительности обработчика
+def instrument(callback):
+    return timed(handler_seconds, handler=callback.__name__)(callback)
+
+# Задача JobQueue: удаление несохраненных результатов поиска старше RESULTS_TTL
+async def purge_results(context: CallbackContext) -> None:
+    removed = await result_store.purge_expired()
+    if removed:
+        logger.info('Удалено устаревших несохраненных вакансий: %s', removed)
+
+# Задача JobQueue: удаление устаревших ответов api.hh.ru из кэша
+async def purge_cache(context: CallbackContext) -> None:
+    removed = await response_cache.purge_expired()
+    if removed:
+        logger.info('Удалено устаревших ответов из кэша: %s', removed)
+
+# Файлы очереди, которые не загрузит ни один из запущенных процессов: общий файл
+# запуска с одним процессом и файлы процессов с номером не меньше WEBHOOK_WORKERS
+def orphaned_spools():
+    paths = [WRITE_SPOOL_PATH]
+    for path in glob.glob(f'{glob.escape(WRITE_SPOOL_PATH)}.*'):
+        suffix = path[len(WRITE_SPOOL_PATH) + 1:]
+        if suffix.isdigit() and int(suffix) >= WEBHOOK_WORKERS:
+            paths.append(path)
+    return paths
+
+# Создание схемы базы данных при запуске
+async def on_startup(application: Application) -> None:
+    await run_db(init_db)
+    # У каждого процесса свой файл очереди, оставшиеся без процесса файлы загружает первый процесс
+    if write_queue.spool_path != WRITE_SPOOL_PATH and application.bot_data.get('worker') == 0:
+        write_queue.start(orphaned_spools())
+    else:
+        write_queue.start()
+    metrics.start_server(metrics.METRICS_PORT + application.bot_data.get('worker', 0))
+
+_route_client = None
+
+# Номер процесса, который обрабатывает обновления пользователя. Все обновления пользователя
+# попадают в один процесс, поэтому его user_data и состояние диалога (ключ - чат и пользователь)
+# меняются последовательно и не теряются из-за отложенной записи в базу
+def update_owner(update: Update):
+    owner = update.effective_user or update.effective_chat
+    return owner.id % WEBHOOK_WORKERS if owner is not None else None
+
+# Обновление, которое балансировщик передал не тому процессу, отправляется процессу-владельцу
+# на его порт и дальше здесь не обрабатывается. Если владелец недоступен, обновление обрабатывается здесь
+async def route_update(update: Update, context: CallbackContext) -> None:
+    global _route_client
+    owner = update_owner(update)
+    if owner is None or owner == context.bot_data.get('worker'):
+        return
+    if _route_client is None:
+        _route_client = httpx.AsyncClient(timeout=5)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    try:
+        response = await _route_client.post(f'http://127.0.0.1:{WEBHOOK_PORT + owner}/{WEBHOOK_PATH}', json=update.to_dict(), headers=headers)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        logger.exception('Не удалось передать обновление процессу %s, обновление обработано здесь', owner)
+        return
+    raise ApplicationHandlerStop
+
+# Запись очереди и закрытие пулов соединений при остановке
+async def on_shutdown(application: Application) -> None:
+    global _route_client
+    await close_client()
+    if _route_client is not None:
+        await _route_client.aclose()
+        _route_client = None
+    await write_queue.stop()
+    await run_db(close_pool)
+    metrics.stop_server()
+
+# Приложение бота. shared - запущено несколько процессов с общим состоянием в Postgres,
+# run_jobs - выполнять периодические задачи (только в одном из процессов)
+def build_application(shared=False, run_jobs=True) -> Application:
+    persistence = PostgresPersistence(shared=shared)
+    # ConversationHandler рассчитан на последовательную обработку обновлений, поэтому
+    # concurrent_updates не включается, а долгие обработчики (поиск, экспорт, find, salary, clear) запускаются
+    # с block=False и не задерживают обновления других пользователей
+    application = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+        .persistence(persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('search', search_start)],
+        entry_points=[CommandHandler('search', instrument(search_start))],
         states={
-            SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_vacancy)],
-            REGION: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_region)],
-            COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_count)],
-            FILTERS: [CallbackQueryHandler(filter_handler)],
-            SALARY: [MessageHandler(filters.TEXT & ~filters.COMMAND, salary_input)],
-            EXPERIENCE: [CallbackQueryHandler(experience_input)],
-            EMPLOYMENT: [CallbackQueryHandler(employment_input)],
-            SCHEDULE: [CallbackQueryHandler(schedule_input)],
+            SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(search_vacancy))],
+            REGION: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(search_region))],
+            COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(search_count))],
+            FILTERS: [CallbackQueryHandler(instrument(filter_handler), block=False)],
+            SALARY: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(salary_input))],
+            EXPERIENCE: [CallbackQueryHandler(instrument(experience_input))],
+            EMPLOYMENT: [CallbackQueryHandler(instrument(employment_input))],
+            SCHEDULE: [CallbackQueryHandler(instrument(schedule_input))],
         },
-        fallbacks=[CommandHandler('start', start)],
+        fallbacks=[CommandHandler('start', instrument(start))],
+        name='search',
+        persistent=True,
     )
 
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('save', save))
-    application.add_handler(CommandHandler('export', export_start))
-    application.add_handler(CommandHandler('clear', clear))
+    # Состояние пользователя читается из базы до того, как обновление попадет в обработчики
+    async def refresh_state(update: Update, context: CallbackContext) -> None:
+        await persistence.refresh(update, context, conv_handler)
+
+    if shared:
+        application.add_handler(TypeHandler(Update, route_update), group=-2)
+    application.add_handler(TypeHandler(Update, refresh_state), group=-1)
+
+    application.add_handler(CommandHandler('start', instrument(start)))
+    application.add_handler(CommandHandler('save', instrument(save)))
+    application.add_handler(CommandHandler('export', instrument(export_start), block=False))
+    application.add_handler(CommandHandler('find', instrument(find), block=False))
+    application.add_handler(CommandHandler('subscribe', instrument(subscribe)))
+    application.add_handler(CommandHandler('subscriptions', instrument(subscriptions_list)))
+    application.add_handler(CommandHandler('unsubscribe', instrument(unsubscribe)))
+    application.add_handler(CommandHandler('clear', instrument(clear), block=False))
+    application.add_handler(CommandHandler('salary', instrument(salary), block=False))
+    application.add_handler(CommandHandler('stats', instrument(stats)))
+    application.add_handler(CommandHandler('claim', instrument(claim)))
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(export_handler, pattern='^export_(csv|chat)$'))
-    application.run_polling()
+    application.add_handler(CallbackQueryHandler(instrument(export_handler), pattern='^export_(csv|csv_gz|csv_zst|parquet|arrow|chat)$', block=False))
+    application.add_handler(CallbackQueryHandler(instrument(find_next), pattern='^find_next$', block=False))
+    if not run_jobs:
+        return application
+    application.job_queue.run_repeating(instrument(refresh_subscriptions), interval=SUBSCRIPTION_INTERVAL, first=SUBSCRIPTION_INTERVAL)
+    application.job_queue.run_repeating(instrument(purge_results), interval=600, first=600)
+    application.job_queue.run_repeating(instrument(purge_cache), interval=600, first=600)
+    return application
+
+# Процесс бота в режиме webhook, слушает WEBHOOK_PORT + index
+def run_worker(index: int) -> None:
+    shared = WEBHOOK_WORKERS > 1
+    if shared:
+        # Результаты поиска должны быть доступны процессу, который получит /save,
+        # общие лимиты запросов к api.hh.ru и отправки в Telegram делятся между процессами
+        result_store.shared = True
+        hh_rate = hh_client.HH_RATE / WEBHOOK_WORKERS
+        hh_client.limiter = TokenBucket(hh_rate, max(1, hh_rate))
+        global_rate = GLOBAL_RATE / WEBHOOK_WORKERS
+        sender.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        sender.chat_rate = CHAT_RATE / WEBHOOK_WORKERS
+        sender.chat_burst = max(1, CHAT_BURST / WEBHOOK_WORKERS)
+        write_queue.spool_path = f'{WRITE_SPOOL_PATH}.{index}'
+        write_queue.direct = True
+    application = build_application(shared=shared, run_jobs=index == 0)
+    application.bot_data['worker'] = index
+    application.run_webhook(
+        listen='0.0.0.0',
+        port=WEBHOOK_PORT + index,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+    )
+
+def main() -> None:
+    if BOT_MODE != 'webhook':
+        build_application().run_polling()
+        return
+    if WEBHOOK_WORKERS == 1:
+        run_worker(0)
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, args=(index,)) for index in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    # Сигнал остановки передается процессам, каждый из них записывает очередь и состояние перед выходом
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
 
 if __name__ == '__main__':
     main()
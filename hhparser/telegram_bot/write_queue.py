@@ -0,0 +1,159 @@
+import os
+import json
+import asyncio
+import logging
+import psycopg2
+from database import run_db, copy_vacancies
+from analytics import salary_analytics
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 5000))  # Вакансий в одной загрузке через COPY
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', 2))  # Максимальная задержка записи, секунды
+WRITE_QUEUE_LIMIT = int(os.getenv('WRITE_QUEUE_LIMIT', 100000))  # Вакансий в очереди, после которых /save ждет записи
+WRITE_SPOOL_PATH = os.getenv('WRITE_SPOOL_PATH', 'write_queue.jsonl')  # Файл для очереди, не записанной при остановке
+WRITE_FAILED_PATH = os.getenv('WRITE_FAILED_PATH', 'write_queue.failed.jsonl')  # Файл для вакансий, которые база не принимает
+
+# Отложенная запись вакансий: сохранения всех пользователей собираются в общие пачки,
+# которые записываются в базу по размеру пачки или по таймеру
+class WriteBehindQueue:
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, interval=WRITE_FLUSH_INTERVAL, limit=WRITE_QUEUE_LIMIT,
+                 spool_path=WRITE_SPOOL_PATH, failed_path=WRITE_FAILED_PATH):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.limit = limit
+        self.spool_path = spool_path
+        self.failed_path = failed_path
+        # Запись сразу при put, без очереди: при нескольких процессах очередь одного процесса
+        # не видна /clear и /export в другом
+        self.direct = False
+        self._buffer = []
+        self._task = None
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._flush_lock = asyncio.Lock()
+
+    # Запуск фоновой записи, очередь, сохраненная в файл при прошлой остановке, загружается обратно.
+    # extra_paths - файлы других процессов, которые больше не запускаются
+    def start(self, extra_paths=()):
+        for path in [self.spool_path, *extra_paths]:
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as file:
+                    spooled = [json.loads(line) for line in file if line.strip()]
+                # Файл версии без разделения по чатам содержит только вакансии, они относятся к чату 0
+                spooled = [(item['chat_id'], item['vacancy']) if 'vacancy' in item else (0, item) for item in spooled]
+                os.remove(path)
+                logger.info('Из %s загружено %s вакансий, не записанных при остановке', path, len(spooled))
+                self._buffer[:0] = spooled
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    # Добавление вакансий чата в очередь, ожидание только при переполнении очереди.
+    # В режиме direct вакансии записываются до возврата из put
+    async def put(self, chat_id, vacancies):
+        if self.direct:
+            items = [(chat_id, v) for v in vacancies]
+            for start in range(0, len(items), self.batch_size):
+                await self._write(items[start:start + self.batch_size])
+            salary_analytics.invalidate(chat_id)
+            return
+        while len(self._buffer) >= self.limit:
+            self._has_space.clear()
+            self._wakeup.set()
+            await self._has_space.wait()
+        self._buffer.extend((chat_id, v) for v in vacancies)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    # Запись всей очереди или только вакансий одного чата.
+    # Пачка удаляется из очереди только после успешной записи
+    async def flush(self, chat_id=None):
+        async with self._flush_lock:
+            while True:
+                batch = [item for item in self._buffer if chat_id is None or item[0] == chat_id][:self.batch_size]
+                if not batch:
+                    break
+                await self._write(batch)
+                if chat_id is None:
+                    # Новые вакансии добавляются в конец, поэтому начало очереди не менялось
+                    del self._buffer[:len(batch)]
+                else:
+                    written = set(map(id, batch))
+                    self._buffer = [item for item in self._buffer if id(item) not in written]
+                # Зарплатная статистика чатов с новыми вакансиями пересчитывается при следующем запросе
+                for batch_chat_id in {item[0] for item in batch}:
+                    salary_analytics.invalidate(batch_chat_id)
+                if len(self._buffer) < self.limit:
+                    self._has_space.set()
+
+    # Запись перед чтением вакансий чата. Ошибка записи не мешает чтению:
+    # вакансии остаются в очереди, а пользователь получает уже записанные
+    async def flush_chat(self, chat_id):
+        try:
+            await self.flush(chat_id)
+        except Exception:
+            logger.exception('Не удалось записать очередь чата %s перед чтением', chat_id)
+
+    # Удаление вакансий чата из очереди перед очисткой. Пачка, которая уже записывается,
+    # дописывается до удаления, поэтому вакансии не появляются после очистки
+    async def discard(self, chat_id):
+        async with self._flush_lock:
+            self._buffer = [item for item in self._buffer if item[0] != chat_id]
+            if len(self._buffer) < self.limit:
+                self._has_space.set()
+
+    # Запись пачки. Если база недоступна, ошибка передается дальше и пачка повторяется по таймеру.
+    # Ошибка в данных делит пачку пополам, пока не останется одна вакансия, которую база не принимает:
+    # она переносится в файл failed_path и не останавливает очередь
+    async def _write(self, batch):
+        try:
+            await run_db(copy_vacancies, batch)
+            return
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception:
+            if len(batch) == 1:
+                logger.exception('Вакансия чата %s не записана, сохранена в %s', batch[0][0], self.failed_path)
+                self._dump(self.failed_path, batch)
+                return
+        middle = len(batch) // 2
+        await self._write(batch[:middle])
+        await self._write(batch[middle:])
+
+    def _dump(self, path, items):
+        with open(path, 'a', encoding='utf-8') as file:
+            for chat_id, v in items:
+                file.write(json.dumps({'chat_id': chat_id, 'vacancy': v}, ensure_ascii=False) + '\n')
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Ошибка записи вакансий в базу данных, повтор через %s с', self.interval)
+
+    # Остановка с записью оставшейся очереди. Если база недоступна, очередь сохраняется в файл
+    async def stop(self):
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Не удалось записать очередь при остановке, вакансии сохранены в %s', self.spool_path)
+            self._dump(self.spool_path, self._buffer)
+            self._buffer = []
+
+    def __len__(self):
+        return len(self._buffer)
+
+write_queue = WriteBehindQueue()